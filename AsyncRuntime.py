@@ -0,0 +1,221 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import partial
+import asyncio
+import logging
+
+import aiohttp
+import requests
+import telebot
+from telebot import apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from Config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Таймаут long polling в секундах и пауза перед повторным запросом обновлений после ошибки
+LONG_POLLING_TIMEOUT = 20
+POLLING_ERROR_DELAY = 3
+# Сколько поток ждёт ответа от цикла событий сверх таймаутов самого запроса. Если цикл остановился или завис,
+# поток получает ошибку, а не ждёт вечно. Без таймаутов запроса используется REQUEST_WAIT_DEFAULT
+REQUEST_WAIT_MARGIN = 5
+REQUEST_WAIT_DEFAULT = 60
+
+_loop = None
+_executor = None
+_stop_event = None
+# Блокировки чатов: обновления одного чата обрабатываются строго по очереди, разных чатов - параллельно.
+# {chat_id: [блокировка, количество обновлений чата в обработке]}
+_chat_locks: dict = {}
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Функция выполняет блокирующую работу (запросы к базе пользователей, поиск по расписанию)
+    в пуле потоков, не останавливая цикл событий
+    :param func: Вызываемая функция
+    :param args: Позиционные аргументы функции
+    :param kwargs: Именованные аргументы функции
+    :return: Результат функции
+    """
+    return await asyncio.get_running_loop().run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+async def _request(method: str, url: str, params: dict = None, files: dict = None, timeout=None) -> requests.Response:
+    """
+    Функция выполняет запрос к Bot API через общую сессию aiohttp, которой пользуется и получение обновлений
+    :param method: HTTP метод
+    :param url: Адрес метода Bot API
+    :param params: Параметры запроса
+    :param files: Файлы запроса
+    :param timeout: Кортеж (таймаут соединения, таймаут чтения) в секундах
+    :return: Ответ в виде requests.Response, который ожидает синхронный telebot
+    :raises requests.ConnectionError: Если не удалось установить соединение, как и при запросе через requests
+    """
+    session = await asyncio_helper.session_manager.get_session()
+
+    # requests сам приводит значения параметров к строкам, aiohttp принимает только строки и числа
+    params = {key: str(value) for key, value in (params or {}).items()}
+
+    data = None
+    if files:
+        data = aiohttp.FormData()
+        for key, value in files.items():
+            if isinstance(value, tuple):
+                data.add_field(key, value[1], filename=value[0])
+            else:
+                data.add_field(key, value, filename=key)
+
+    connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    client_timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+    try:
+        async with session.request(method, url, params=params, data=data, timeout=client_timeout) as response:
+            result = requests.Response()
+            result.status_code = response.status
+            result.reason = response.reason
+            result.url = str(response.url)
+            result.encoding = "utf-8"
+            result._content = await response.read()
+            return result
+    except aiohttp.ClientConnectorError as error:
+        # Запрос не был отправлен: очередь отправки может безопасно его повторить
+        raise requests.ConnectionError(error) from error
+
+
+def _send_request(method: str, url: str, params: dict = None, files: dict = None, timeout=None, proxies=None):
+    """
+    Функция подменяет отправку запросов синхронного telebot (apihelper.CUSTOM_REQUEST_SENDER):
+    запрос из потока обработчика передаётся в цикл событий и выполняется через общую сессию aiohttp.
+    Если цикл событий не запущен, запрос отправляется через requests
+    :param method: HTTP метод
+    :param url: Адрес метода Bot API
+    :param params: Параметры запроса
+    :param files: Файлы запроса
+    :param timeout: Кортеж (таймаут соединения, таймаут чтения) в секундах
+    :param proxies: Прокси для requests
+    :return: Ответ в виде requests.Response
+    :raises apihelper.ApiException: Если цикл событий не выполнил запрос за отведённое время. Запрос мог
+        дойти до Telegram, поэтому очередь отправки не повторяет так упавшую отправку сообщения
+    """
+    try:
+        asyncio.get_running_loop()
+        in_event_loop = True
+    except RuntimeError:
+        in_event_loop = False
+
+    loop = _loop
+    if loop is None or not loop.is_running() or in_event_loop:
+        return requests.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+    timeouts = timeout if isinstance(timeout, tuple) else (timeout,)
+    wait_timeout = sum(part or REQUEST_WAIT_DEFAULT for part in timeouts) + REQUEST_WAIT_MARGIN
+
+    future = asyncio.run_coroutine_threadsafe(_request(method, url, params, files, timeout), loop)
+    try:
+        return future.result(wait_timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise apihelper.ApiException(f"Цикл событий не выполнил запрос за {wait_timeout} с", url.rsplit("/", 1)[-1],
+                                     None) from None
+
+
+def _get_chat_id(update: telebot.types.Update):
+    """
+    Функция определяет чат, к которому относится обновление
+    :param update: Объект обновления
+    :return: ID чата или None, если обновление не связано с чатом
+    """
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+async def _process_update(bot: telebot.TeleBot, update: telebot.types.Update):
+    """
+    Функция передаёт обновление обработчикам синхронного бота в пуле потоков.
+    Обновления одного чата выполняются по очереди, чтобы шаги меню не перепутались
+    :param bot: Синхронный бот с зарегистрированными обработчиками
+    :param update: Объект обновления
+    """
+    chat_id = _get_chat_id(update)
+    chat_lock = _chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+    chat_lock[1] += 1
+
+    try:
+        async with chat_lock[0]:
+            await run_blocking(bot.process_new_updates, [update])
+    except Exception:
+        logger.exception("Ошибка при обработке обновления %s", update.update_id)
+    finally:
+        chat_lock[1] -= 1
+        if not chat_lock[1]:
+            del _chat_locks[chat_id]
+
+
+async def _polling(bot: telebot.TeleBot):
+    """
+    Цикл получения обновлений через AsyncTeleBot. Каждое обновление обрабатывается отдельной задачей,
+    поэтому медленный обработчик не задерживает получение следующих обновлений
+    :param bot: Синхронный бот с зарегистрированными обработчиками
+    """
+    global _loop, _executor, _stop_event
+
+    _loop = asyncio.get_running_loop()
+    _stop_event = asyncio.Event()
+    _executor = ThreadPoolExecutor(max_workers=get_settings().update_workers, thread_name_prefix="UpdateWorker")
+    apihelper.CUSTOM_REQUEST_SENDER = _send_request
+
+    async_bot = AsyncTeleBot(bot.token)
+    tasks = set()
+    offset = None
+
+    try:
+        # После работы в режиме webhook Telegram отвечает 409 на каждый getUpdates, пока вебхук не удалён
+        await async_bot.delete_webhook()
+        while not _stop_event.is_set():
+            try:
+                updates = await async_bot.get_updates(offset=offset, timeout=LONG_POLLING_TIMEOUT,
+                                                      request_timeout=LONG_POLLING_TIMEOUT + 5)
+            except Exception:
+                logger.exception("Не удалось получить обновления")
+                await asyncio.sleep(POLLING_ERROR_DELAY)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                task = asyncio.create_task(_process_update(bot, update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        apihelper.CUSTOM_REQUEST_SENDER = None
+        _executor.shutdown(wait=True)
+        await async_bot.close_session()
+        _loop, _executor = None, None
+
+
+def run_async_bot(bot: telebot.TeleBot):
+    """
+    Функция запускает бота в асинхронном режиме: обновления получает AsyncTeleBot, обработчики синхронного
+    бота выполняются параллельно в пуле потоков, а все запросы к Bot API идут через одну сессию aiohttp.
+    Синхронный бот должен быть создан с threaded=False
+    :param bot: Синхронный бот с зарегистрированными обработчиками
+    """
+    try:
+        asyncio.run(_polling(bot))
+    except KeyboardInterrupt:
+        pass
+
+
+def stop_async_bot():
+    """
+    Функция останавливает асинхронный цикл получения обновлений после текущего запроса
+    """
+    if _loop is not None and _stop_event is not None:
+        _loop.call_soon_threadsafe(_stop_event.set)
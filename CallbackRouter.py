@@ -0,0 +1,171 @@
+import threading
+import logging
+import time
+
+from ScheduleStore import station_priority
+
+logger = logging.getLogger(__name__)
+
+# Telegram не присылает callback_data длиннее 64 байт, всё, что длиннее, - подделка
+MAX_CALLBACK_DATA_SIZE = 64
+
+# {callback_data: (название маршрута, обработчик, разбор данных)}
+_exact_routes: dict = {}
+# {префикс: (название маршрута, обработчик, разбор полезной части)}
+_prefix_routes: dict = {}
+# Длины зарегистрированных префиксов от длинной к короткой: поиск обработчика делает не больше
+# одного обращения к словарю на каждую длину, сколько бы префиксов ни было зарегистрировано
+_prefix_lengths: list = []
+
+_stats_lock = threading.Lock()
+# {название маршрута: [количество вызовов, суммарное время, максимальное время]}
+_route_stats: dict = {}
+_rejected_count = 0
+
+
+def parse_station(payload: str) -> str:
+    """
+    Функция проверяет, что в данных кнопки передана известная станция
+    :param payload: Часть callback_data после префикса
+    :return: Название станции
+    :raises ValueError: Если станция неизвестна
+    """
+    if payload not in station_priority:
+        raise ValueError(f"Неизвестная станция {payload}")
+    return payload
+
+
+def parse_trip(payload: str) -> tuple[str, str]:
+    """
+    Функция разбирает маршрут вида "станция->станция"
+    :param payload: Часть callback_data после префикса
+    :return: Кортеж (начальная станция, конечная станция)
+    :raises ValueError: Если маршрут записан неверно или станции неизвестны
+    """
+    start_station, finish_station = payload.split("->")
+    return parse_station(start_station), parse_station(finish_station)
+
+
+def parse_saved_trip(payload: str) -> tuple[str, str]:
+    """
+    Функция разбирает маршрут вида "станция->станция", не проверяя станции. Нужна для кнопок с уже
+    сохранёнными маршрутами: пользователь должен иметь возможность удалить маршрут, даже если станция
+    переименована или маршрут был сохранён с ошибкой
+    :param payload: Часть callback_data после префикса
+    :return: Кортеж (начальная станция, конечная станция)
+    :raises ValueError: Если маршрут записан неверно
+    """
+    start_station, finish_station = payload.split("->")
+    return start_station, finish_station
+
+
+def callback_handler(*callback_data: str, parser=None, name: str = None):
+    """
+    Декоратор регистрирует обработчик кнопок с точно совпадающими callback_data
+    :param callback_data: Значения callback_data
+    :param parser: Функция разбора callback_data, результат передаётся обработчику вторым аргументом
+    :param name: Название маршрута в метриках. По умолчанию имя обработчика
+    """
+    def decorator(handler):
+        for data in callback_data:
+            _exact_routes[data] = (name or handler.__name__, handler, parser)
+        return handler
+
+    return decorator
+
+
+def callback_prefix_handler(prefix: str, parser=None, name: str = None):
+    """
+    Декоратор регистрирует обработчик кнопок, callback_data которых начинается с префикса
+    :param prefix: Префикс callback_data
+    :param parser: Функция разбора части после префикса, результат передаётся обработчику вторым аргументом
+    :param name: Название маршрута в метриках. По умолчанию имя обработчика
+    """
+    def decorator(handler):
+        global _prefix_lengths
+
+        _prefix_routes[prefix] = (name or handler.__name__, handler, parser)
+        _prefix_lengths = sorted({len(registered) for registered in _prefix_routes}, reverse=True)
+        return handler
+
+    return decorator
+
+
+def _find_route(data: str):
+    """
+    Функция находит маршрут для callback_data: сначала среди точных совпадений, затем по самому длинному префиксу
+    :param data: callback_data
+    :return: Кортеж (название маршрута, обработчик, разбор данных, данные для разбора) или None
+    """
+    route = _exact_routes.get(data)
+    if route is not None:
+        return *route, data
+
+    for length in _prefix_lengths:
+        route = _prefix_routes.get(data[:length])
+        if route is not None:
+            return *route, data[length:]
+    return None
+
+
+def _reject(data, reason: str) -> bool:
+    """
+    Функция учитывает отклонённый callback
+    :param data: callback_data
+    :param reason: Причина отклонения
+    :return: False
+    """
+    global _rejected_count
+
+    with _stats_lock:
+        _rejected_count += 1
+    logger.debug("Отклонён callback %r: %s", data, reason)
+    return False
+
+
+def dispatch_callback(call) -> bool:
+    """
+    Функция передаёт callback обработчику зарегистрированного маршрута и замеряет время его работы.
+    Слишком длинные, неизвестные и неразобранные данные отклоняются до вызова обработчика
+    :param call: Объект callback-запроса от пользователя
+    :return: True, если callback обработан, и False, если отклонён
+    """
+    data = call.data
+    if not data or len(data.encode("utf-8")) > MAX_CALLBACK_DATA_SIZE:
+        return _reject(data, "пустые или слишком длинные данные")
+
+    route = _find_route(data)
+    if route is None:
+        return _reject(data, "неизвестный маршрут")
+
+    name, handler, parser, payload = route
+    args = ()
+    if parser is not None:
+        try:
+            args = (parser(payload),)
+        except (ValueError, KeyError):
+            return _reject(data, f"неверные данные для маршрута {name}")
+
+    started_at = time.perf_counter()
+    try:
+        handler(call, *args)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        with _stats_lock:
+            stats = _route_stats.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+    return True
+
+
+def get_callback_stats() -> dict:
+    """
+    Функция возвращает метрики обработки callback
+    :return: Словарь {"routes": {маршрут: {"count", "total_time", "average_time", "max_time"}}, "rejected": число}
+    """
+    with _stats_lock:
+        routes = {name: {"count": count, "total_time": total_time, "average_time": total_time / count,
+                         "max_time": max_time}
+                  for name, (count, total_time, max_time) in _route_stats.items()}
+        return {"routes": routes, "rejected": _rejected_count}
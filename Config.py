@@ -0,0 +1,164 @@
+from dataclasses import dataclass, fields, replace, asdict
+from os import environ, replace as replace_file
+import threading
+import json
+
+CONFIG_PATH = "config.json"
+# Префикс переменных окружения: METRO_BOT_MAIN_BOT_TOKEN, METRO_BOT_MODE и т.д.
+ENV_PREFIX = "METRO_BOT_"
+
+# Заглушки токенов из StartSettings.py: такие токены считаются незаданными
+TOKEN_PLACEHOLDERS = ("ваш_токен_основного_бота", "ваш_токен_бота_для_обратной_связи")
+
+BOT_MODES = ("polling", "webhook")
+BOT_RUNTIMES = ("sync", "async")
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Настройки бота. Значения по умолчанию переопределяются файлом config.json,
+    а его значения - переменными окружения с префиксом METRO_BOT_
+    """
+    main_bot_token: str = ""
+    feedback_bot_token: str = ""
+    admin_chat_id: int = 740063203
+    timezone: str = "Asia/Yekaterinburg"
+    mode: str = "polling"
+    runtime: str = "sync"
+    response_cache_size: int = 512
+    session_cache_size: int = 10000
+    update_workers: int = 16
+    parse_workers: int = 1
+    # Периодичность обновления ссылок на страницы станций и самих страниц с расписанием
+    # и интервал проверки, не пора ли что-то обновить, в секундах
+    links_refresh_interval: int = 30 * 24 * 60 * 60
+    pages_refresh_interval: int = 7 * 24 * 60 * 60
+    refresh_check_interval: int = 60 * 60
+    webhook_url: str = ""
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8443
+    webhook_path: str = "/telegram"
+    webhook_secret: str = ""
+    webhook_queue_size: int = 1000
+    webhook_certificate: str = ""
+    webhook_private_key: str = ""
+
+
+_settings_lock = threading.Lock()
+_settings = None
+
+
+def _read_config_file(path: str) -> dict:
+    """
+    Функция читает файл с настройками
+    :param path: Путь к файлу
+    :return: Словарь с настройками или пустой словарь, если файла нет
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def load_settings(path: str = CONFIG_PATH, environment: dict = None) -> Settings:
+    """
+    Функция собирает настройки из файла и переменных окружения и проверяет их
+    :param path: Путь к файлу с настройками
+    :param environment: Словарь переменных окружения. По умолчанию os.environ
+    :return: Объект настроек
+    :raises ValueError: Если в настройках неизвестный ключ или недопустимое значение
+    """
+    if environment is None:
+        environment = environ
+
+    values = _read_config_file(path)
+    known_fields = {field.name: field.type for field in fields(Settings)}
+
+    unknown_keys = set(values) - set(known_fields)
+    if unknown_keys:
+        raise ValueError(f"Неизвестные настройки в {path}: {', '.join(sorted(unknown_keys))}")
+
+    for name in known_fields:
+        env_value = environment.get(f"{ENV_PREFIX}{name.upper()}")
+        if env_value is not None:
+            values[name] = env_value
+
+    settings = Settings(**{name: known_fields[name](value) for name, value in values.items()})
+
+    if settings.mode not in BOT_MODES:
+        raise ValueError(f"Недопустимый режим получения обновлений {settings.mode}, ожидается один из {BOT_MODES}")
+    if settings.runtime not in BOT_RUNTIMES:
+        raise ValueError(f"Недопустимый режим работы {settings.runtime}, ожидается один из {BOT_RUNTIMES}")
+    if settings.mode == "webhook" and not settings.webhook_url:
+        raise ValueError("Для режима webhook нужно задать webhook_url - внешний адрес сервера бота")
+    if settings.parse_workers < 1:
+        raise ValueError(f"Число процессов для разбора страниц должно быть не меньше 1: {settings.parse_workers}")
+    for name in ("links_refresh_interval", "pages_refresh_interval", "refresh_check_interval"):
+        if getattr(settings, name) <= 0:
+            raise ValueError(f"Интервал {name} должен быть больше нуля: {getattr(settings, name)}")
+    if not settings.webhook_path.startswith("/"):
+        raise ValueError(f"Путь вебхука должен начинаться с /: {settings.webhook_path}")
+    return settings
+
+
+def is_token_set(token: str) -> bool:
+    """
+    Функция проверяет, что токен задан и не является заглушкой
+    :param token: Токен бота
+    :return: True, если токен задан
+    """
+    return bool(token) and token not in TOKEN_PLACEHOLDERS
+
+
+def get_settings() -> Settings:
+    """
+    Функция возвращает настройки бота. Настройки загружаются один раз при первом обращении
+    :return: Объект настроек
+    """
+    global _settings
+
+    if _settings is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = load_settings()
+    return _settings
+
+
+def save_settings(settings: Settings, path: str = CONFIG_PATH):
+    """
+    Функция записывает настройки в файл через временный файл и сбрасывает загруженные настройки
+    :param settings: Объект настроек
+    :param path: Путь к файлу с настройками
+    """
+    global _settings
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(asdict(settings), file, ensure_ascii=False, indent=4)
+    replace_file(temp_path, path)
+
+    with _settings_lock:
+        _settings = None
+
+
+def load_file_settings(path: str = CONFIG_PATH) -> Settings:
+    """
+    Функция читает настройки только из файла, без переменных окружения
+    :param path: Путь к файлу с настройками
+    :return: Объект настроек
+    """
+    return load_settings(path, environment={})
+
+
+def update_settings(path: str = CONFIG_PATH, **changes) -> Settings:
+    """
+    Функция изменяет отдельные настройки в файле, не затрагивая остальные
+    :param path: Путь к файлу с настройками
+    :param changes: Новые значения настроек
+    :return: Объект обновлённых настроек
+    """
+    settings = replace(Settings(**_read_config_file(path)), **changes)
+    save_settings(settings, path)
+    return settings
@@ -1,18 +1,32 @@
+from collections import OrderedDict
+from functools import lru_cache
+import threading
 import datetime
-import pytz
 import telebot
 from telebot import types
 
-from UsersDataBase import (add_user, get_current_user, update_user_data, add_favorite_trip, get_favorite_trips,
-                           remove_favorite_trip)
+from UsersDataBase import (create_table, enqueue_add_user, get_current_user, update_user_data, add_favorite_trip,
+                           get_favorite_trips, remove_favorite_trip)
 from ScheduleGiver import get_closest_trains
-from ScheduleParser import update_main_page, update_all_links, update_schedule_pages, update_schedule_json
-
-token_main_bot, token_feedback_bot = get_favorite_trips(1)
-main_bot = telebot.TeleBot(token_main_bot)
-feedback_bot = telebot.TeleBot(token_feedback_bot)
-
-MY_CHAT_ID = 740063203
+from CallbackRouter import (dispatch_callback, callback_handler, callback_prefix_handler, parse_station,
+                            parse_trip, parse_saved_trip)
+from MetroClock import now
+from ScheduleUpdater import start_schedule_updater
+from Config import get_settings, is_token_set
+from SendQueue import queue_send_message, queue_edit_message_text, queue_delete_message
+
+settings = get_settings()
+if not is_token_set(settings.main_bot_token) or not is_token_set(settings.feedback_bot_token):
+    raise RuntimeError("Не заданы токены ботов: запустите StartSettings.py или задайте переменные окружения "
+                       "METRO_BOT_MAIN_BOT_TOKEN и METRO_BOT_FEEDBACK_BOT_TOKEN")
+
+# В асинхронном режиме и в режиме вебхука обработчики вызываются из собственных пулов потоков
+# AsyncRuntime и WebhookServer, пул telebot не нужен
+use_telebot_threads = settings.runtime == "sync" and settings.mode == "polling"
+main_bot = telebot.TeleBot(settings.main_bot_token, threaded=use_telebot_threads)
+feedback_bot = telebot.TeleBot(settings.feedback_bot_token, threaded=use_telebot_threads)
+
+MY_CHAT_ID = settings.admin_chat_id
 
 station_button_names = {"Kosmonavtov_Avenue": "👨‍🚀 Проспект космонавтов",
                         "Uralmash": "🏭 Уралмаш",
@@ -32,16 +46,9 @@ def start_func(message):
 
     :param message: Объект сообщения от пользователя
     """
-    markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
-    main_menu_button = types.KeyboardButton("Главное меню 📝")
-    settings_button = types.KeyboardButton("Настройки 🛠")
-    feedback_button = types.KeyboardButton("Обратная связь ☺️")
-
-    markup.add(main_menu_button)
-    markup.row(feedback_button, settings_button)
-
     user_data = message.from_user
-    add_user(message.chat.id, user_data.username, user_data.first_name, user_data.last_name, datetime.date.today())
+    enqueue_add_user(message.chat.id, user_data.username, user_data.first_name, user_data.last_name,
+                     datetime.date.today())
 
     hello_message = (f"Привет, {user_data.first_name}! 👋\n"
                      "Я бот, который поможет узнать расписание ближайших поездов в метрополитене Екатеринбурга!\n"
@@ -64,7 +71,8 @@ def start_func(message):
                      "Жми по функциям выше или в меню\n"
                      "👇👇👇")
 
-    main_bot.send_message(message.chat.id, hello_message, reply_markup=markup, parse_mode="html")
+    queue_send_message(main_bot, message.chat.id, hello_message, reply_markup=get_main_reply_marcup(),
+                       parse_mode="html")
 
 
 @main_bot.message_handler(func=lambda message:
@@ -77,7 +85,7 @@ def main_menu(message):
     :param message: Объект сообщения от пользователя
     """
     send_first_station_menu(message)
-    main_bot.send_message(message.chat.id, "⌛")
+    queue_send_message(main_bot, message.chat.id, "⌛")
 
 
 @main_bot.message_handler(func=lambda message:
@@ -90,39 +98,10 @@ def settings_menu(message):
     :param message: Объект сообщения от пользователя
     """
     settings_message = "Из списка ниже выберите желаемое количество поездов, которые бот будет выводит в расписании:"
-    num_translator = {
-        1: "1⃣",
-        2: "2⃣",
-        3: "3⃣",
-        4: "4⃣",
-        5: "5⃣",
-        6: "6⃣",
-        7: "7⃣",
-        8: "8⃣",
-        9: "9⃣",
-        10: "🔟",
-    }
     current_user_settings = get_current_user(message.chat.id).get("count_trains")
 
-    markup = types.InlineKeyboardMarkup()
-
-    first_line = []
-    second_line = []
-    for i in range(1, 11):
-        if i != current_user_settings:
-            button = types.InlineKeyboardButton(str(num_translator.get(i)), callback_data=str(i))
-        else:
-            button = types.InlineKeyboardButton("✅", callback_data="pass")
-
-        if len(first_line) < 5:
-            first_line.append(button)
-        else:
-            second_line.append(button)
-
-    markup.row(*first_line)
-    markup.row(*second_line)
-
-    main_bot.send_message(message.chat.id, settings_message, reply_markup=markup)
+    queue_send_message(main_bot, message.chat.id, settings_message,
+                       reply_markup=get_settings_marcup(current_user_settings))
 
 
 @main_bot.message_handler(func=lambda message:
@@ -139,7 +118,7 @@ def feedback_menu(message):
                         "Так же, если вы нашли какой-то баг - пишите, но, надеюсь, нет :)\n"
                         "Заранее спасибо за любую обратную связь ☺️")
 
-    main_bot.send_message(message.chat.id, feedback_message)
+    queue_send_message(main_bot, message.chat.id, feedback_message)
 
 
 @main_bot.message_handler(func=lambda message: message.text.lower().startswith('отзыв'))
@@ -149,122 +128,205 @@ def send_me_feedback(message):
 
     :param message: Объект сообщения от пользователя
     """
-    feedback_bot.send_message(MY_CHAT_ID, f"Сообщение отправлено {datetime.date.today()} в "
-                                          f"{int(datetime.datetime.now(pytz.utc).strftime('%H')) + 5}:"
-                                          f"{datetime.datetime.now().strftime('%M')} "
-                                          f"пользователем @{message.from_user.username} с chad_id {message.chat.id}:\n"
-                                          f"{message.text[5:]}")
-    main_bot.send_message(message.chat.id, "Спасибо! Ваше сообщение передано разработчику!\n"
-                                           "Приятного пользования! ❤️\n"
-                                           "👇👇👇")
+    sent_at = now()
+    feedback_text = (f"Сообщение отправлено {sent_at:%Y-%m-%d} в {sent_at:%H:%M} "
+                     f"пользователем @{message.from_user.username} с chad_id {message.chat.id}:\n"
+                     f"{message.text[5:]}")
+    thanks_message = ("Спасибо! Ваше сообщение передано разработчику!\n"
+                      "Приятного пользования! ❤️\n"
+                      "👇👇👇")
+
+    queue_send_message(feedback_bot, MY_CHAT_ID, feedback_text)
+    queue_send_message(main_bot, message.chat.id, thanks_message)
 
 
 @main_bot.callback_query_handler(func=lambda call: True)
 def callback_query(call):
     """
-    Обрабатывает callback-запросы от inline-кнопок.
+    Обрабатывает callback-запросы от inline-кнопок, передавая их обработчикам из таблицы маршрутов CallbackRouter.
+
+    :param call: Объект callback-запроса от пользователя
+    """
+    dispatch_callback(call)
+
+
+@callback_handler(*map(str, range(1, 11)), parser=int)
+def set_count_trains(call, count_trains: int):
+    """
+    Сохраняет выбранное пользователем количество поездов.
 
     :param call: Объект callback-запроса от пользователя
+    :param count_trains: Количество поездов от 1 до 10
     """
-    data: str = call.data
     message = call.message
+    queue_delete_message(main_bot, message.chat.id, message.message_id)
+    update_user_data(message.chat.id, [6], [count_trains])
+    settings_changed_message = ("Настройки изменены!\n"
+                                "Вызывайте меню, тыкнув сюда ➜ /menu или выбрав соответствующий пункт тут\n"
+                                "👇👇👇")
+    queue_send_message(main_bot, message.chat.id, settings_changed_message)
+
+
+@callback_handler("pass", "finish_pass", "add_pass")
+def ignore_selected_button(call):
+    """
+    Обрабатывает нажатие на уже выбранную кнопку - ничего не делает.
+
+    :param call: Объект callback-запроса от пользователя
+    """
+
+
+@callback_prefix_handler("start_", parser=parse_station)
+def select_start_station(call, selected_station: str):
+    """
+    Запоминает станцию начала движения и рисует меню выбора второй станции.
+
+    :param call: Объект callback-запроса от пользователя
+    :param selected_station: Выбранная станция
+    """
+    update_user_data(call.message.chat.id, [5], [selected_station])
+    draw_second_station_menu(call.message, selected_station)
+
+
+@callback_prefix_handler("finish_", parser=parse_station)
+def select_finish_station(call, finish_station: str):
+    """
+    Отправляет расписание поездов от сохранённой станции начала движения до выбранной станции.
 
-    # Настройка количества поездов у пользователя
-    if data in ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10"]:
-        main_bot.delete_message(message.chat.id, message.message_id)
-        update_user_data(message.chat.id, [6], [int(data)])
-        main_bot.send_message(message.chat.id, "Настройки изменены!\n"
-                                               "Вызывайте меню, тыкнув сюда ➜ /menu или выбрав соответствующий пункт "
-                                               "тут\n"
-                                               "👇👇👇")
-
-    # Обработка callback от уже выбранной станции
-    if data.endswith("pass"):
-        pass
-
-    # Если пользователь выбрал станцию начала движения:
-    elif data.startswith("start_"):
-        selected_station = call.data[6:]
-        update_user_data(message.chat.id, [5], [selected_station])
-
-        draw_second_station_menu(message, selected_station)
-
-    # Если пользователь выбрал станцию окончания маршрута
-    elif data.startswith("finish_"):
-        main_bot.edit_message_text("🤔", message.chat.id, message.message_id + 1)
-        try:
-            schedule_message = get_closest_trains(
-                get_current_user(message.chat.id).get("last_selected_start_station"),
-                call.data[7:],
-                get_current_user(message.chat.id).get("count_trains")
-            )
-        except TypeError:
-            schedule_message = 'Пожалуйста, нажмите кнопку "🔙 Назад" и используйте только 1 меню для управления ботом.'
-
-        main_bot.edit_message_text(schedule_message, message.chat.id, message.message_id + 1, parse_mode="html")
-
-    # Отправка расписания поездов при нажатии на выбранный маршрут
-    elif data.startswith("favorite_"):
-        main_bot.edit_message_text("🤔", message.chat.id, message.message_id + 1)
-        start_station, finish_station = data[9:].split("->")
+    :param call: Объект callback-запроса от пользователя
+    :param finish_station: Выбранная станция окончания маршрута
+    """
+    message = call.message
+    queue_edit_message_text(main_bot, "🤔", message.chat.id, message.message_id + 1)
+    try:
+        current_user = get_current_user(message.chat.id)
         schedule_message = get_closest_trains(
-            start_station,
+            current_user.get("last_selected_start_station"),
             finish_station,
-            get_current_user(message.chat.id).get("count_trains")
+            current_user.get("count_trains")
         )
+    except (TypeError, KeyError):
+        schedule_message = 'Пожалуйста, нажмите кнопку "🔙 Назад" и используйте только 1 меню для управления ботом.'
+
+    queue_edit_message_text(main_bot, schedule_message, message.chat.id, message.message_id + 1, parse_mode="html")
+
+
+@callback_prefix_handler("favorite_", parser=parse_trip)
+def send_favorite_trip_schedule(call, trip: tuple[str, str]):
+    """
+    Отправляет расписание поездов по выбранному избранному маршруту.
 
-        main_bot.edit_message_text(schedule_message, message.chat.id, message.message_id + 1, parse_mode="html")
+    :param call: Объект callback-запроса от пользователя
+    :param trip: Кортеж (начальная станция, конечная станция)
+    """
+    message = call.message
+    queue_edit_message_text(main_bot, "🤔", message.chat.id, message.message_id + 1)
+    schedule_message = get_closest_trains(*trip, get_current_user(message.chat.id).get("count_trains"))
 
-    # Если пользователь выбрал сохранённый путь для удаления. Отрисовка меню подтверждения
-    elif data.startswith("remove_"):
-        selected_trip_to_remove = call.data[7:]
-        update_user_data(message.chat.id, [7], [selected_trip_to_remove])
-        draw_confirm_remove_trip_menu(message)
+    queue_edit_message_text(main_bot, schedule_message, message.chat.id, message.message_id + 1, parse_mode="html")
 
-    # Удаление маршрута из избранного и отрисовка меню удаления маршрутов
-    elif data == "confirm_delete":
-        remove_favorite_trip(message.chat.id, get_current_user(message.chat.id).get("selected_trip_to_remove"))
 
-        update_user_data(message.chat.id, [7], [None])
-        draw_remove_favorite_trip_menu(message)
+@callback_prefix_handler("remove_", parser=parse_saved_trip)
+def select_trip_to_remove(call, trip: tuple[str, str]):
+    """
+    Запоминает выбранный для удаления маршрут и рисует меню подтверждения.
 
-    # Возврат в мею избранных маршрутов
-    elif data == "go_to_favorite_trips_menu":
-        draw_favorite_trips_menu(message)
+    :param call: Объект callback-запроса от пользователя
+    :param trip: Кортеж (начальная станция, конечная станция)
+    """
+    update_user_data(call.message.chat.id, [7], ["->".join(trip)])
+    draw_confirm_remove_trip_menu(call.message)
+
+
+@callback_handler("confirm_delete")
+def confirm_remove_trip(call):
+    """
+    Удаляет маршрут из избранного и рисует меню удаления маршрутов.
+
+    :param call: Объект callback-запроса от пользователя
+    """
+    message = call.message
+    change_favorite_trips(remove_favorite_trip, message.chat.id,
+                          get_current_user(message.chat.id).get("selected_trip_to_remove"))
+
+    update_user_data(message.chat.id, [7], [None])
+    draw_remove_favorite_trip_menu(message)
+
+
+@callback_handler("go_to_favorite_trips_menu")
+def go_to_favorite_trips_menu(call):
+    """
+    Возвращает в меню избранных маршрутов.
+
+    :param call: Объект callback-запроса от пользователя
+    """
+    draw_favorite_trips_menu(call.message)
 
-    # Отрисовка станций для добавления избранного маршрута шаг 1
-    elif data == "draw_add_favorite_trip_menu_step_one":
-        draw_add_favorite_trip_menu_step_one(message)
 
-    # Отрисовка станций для добавления избранного маршрута шаг 2
-    elif data.startswith("select_"):
-        selected_station = call.data[7:]
-        update_user_data(message.chat.id, [5], [selected_station])
+@callback_handler("draw_add_favorite_trip_menu_step_one")
+def go_to_add_favorite_trip_step_one(call):
+    """
+    Рисует станции для добавления избранного маршрута (шаг 1).
 
-        draw_add_favorite_trip_menu_step_two(message, selected_station)
+    :param call: Объект callback-запроса от пользователя
+    """
+    draw_add_favorite_trip_menu_step_one(call.message)
 
-    # Добавление нового избранного маршрута в базу данных
-    elif data.startswith("add_"):
-        start_station = get_current_user(message.chat.id).get("last_selected_start_station")
-        finish_station = data[4:]
 
-        selected_trip = f"{start_station}->{finish_station}"
+@callback_prefix_handler("select_", parser=parse_station)
+def go_to_add_favorite_trip_step_two(call, selected_station: str):
+    """
+    Запоминает начальную станцию нового избранного маршрута и рисует станции для шага 2.
 
-        if selected_trip not in get_favorite_trips(message.chat.id):
-            add_favorite_trip(message.chat.id, f"{start_station}->{finish_station}")
-            update_user_data(message.chat.id, [5], [None])
+    :param call: Объект callback-запроса от пользователя
+    :param selected_station: Выбранная начальная станция
+    """
+    update_user_data(call.message.chat.id, [5], [selected_station])
+    draw_add_favorite_trip_menu_step_two(call.message, selected_station)
 
-            draw_favorite_trips_menu(message)
 
-    # Отрисовка меню выбора сохранённого пути для удаления
-    elif data == "draw_remove_favorite_trip_menu":
-        update_user_data(message.chat.id, [7], [None])
-        draw_remove_favorite_trip_menu(message)
+@callback_prefix_handler("add_", parser=parse_station)
+def add_new_favorite_trip(call, finish_station: str):
+    """
+    Добавляет новый избранный маршрут в базу данных.
 
-    # Кнопка возврата на главную страницу меню
-    elif data == "back_to_first_station_menu":
+    :param call: Объект callback-запроса от пользователя
+    :param finish_station: Выбранная конечная станция
+    """
+    message = call.message
+    try:
+        # Начальной станции нет, например, после повторного нажатия: маршрут уже добавлен первым нажатием
+        start_station = parse_station(get_current_user(message.chat.id).get("last_selected_start_station"))
+    except ValueError:
+        return
+
+    # Вставка идемпотентна: уже сохранённый маршрут не добавляется повторно
+    if change_favorite_trips(add_favorite_trip, message.chat.id, f"{start_station}->{finish_station}"):
         update_user_data(message.chat.id, [5], [None])
-        redraw_first_station_menu(message)
+
+        draw_favorite_trips_menu(message)
+
+
+@callback_handler("draw_remove_favorite_trip_menu")
+def go_to_remove_favorite_trip_menu(call):
+    """
+    Рисует меню выбора сохранённого маршрута для удаления.
+
+    :param call: Объект callback-запроса от пользователя
+    """
+    update_user_data(call.message.chat.id, [7], [None])
+    draw_remove_favorite_trip_menu(call.message)
+
+
+@callback_handler("back_to_first_station_menu")
+def back_to_first_station_menu(call):
+    """
+    Возвращает на главную страницу меню.
+
+    :param call: Объект callback-запроса от пользователя
+    """
+    update_user_data(call.message.chat.id, [5], [None])
+    redraw_first_station_menu(call.message)
 
 
 def get_favorite_trips_marcup(message, add_to_callback) -> types.InlineKeyboardMarkup:
@@ -329,36 +391,220 @@ def get_second_station_marcup(add_to_callback, selected_station: str) -> types.I
     return markup
 
 
-def send_first_station_menu(message):
+# Меню выбора станций: (префикс callback станций, текст дополнительной кнопки, callback дополнительной кнопки)
+FIRST_STATION_MENU = ("start_", "✨ Избранные маршруты ✨", "go_to_favorite_trips_menu")
+SECOND_STATION_MENU = ("finish_", "🔙 Назад", "back_to_first_station_menu")
+ADD_TRIP_STEP_ONE_MENU = ("select_", "🔙 Назад", "go_to_favorite_trips_menu")
+ADD_TRIP_STEP_TWO_MENU = ("add_", "🔙 Назад", "draw_add_favorite_trip_menu_step_one")
+
+# Кнопки под списком избранных маршрутов для каждого префикса: строки из пар (текст, callback)
+favorite_trips_menu_buttons = {
+    "favorite_": [[("➖ Удалить маршрут", "draw_remove_favorite_trip_menu"),
+                   ("➕ Добавить маршрут", "draw_add_favorite_trip_menu_step_one")],
+                  [("🔙 Назад", "back_to_first_station_menu")]],
+    "remove_": [[("🔙 Назад", "go_to_favorite_trips_menu")]]
+}
+
+num_translator = {
+    1: "1⃣",
+    2: "2⃣",
+    3: "3⃣",
+    4: "4⃣",
+    5: "5⃣",
+    6: "6⃣",
+    7: "7⃣",
+    8: "8⃣",
+    9: "9⃣",
+    10: "🔟",
+}
+
+# Клавиатуры избранных маршрутов: {(chat_id, префикс): JSON клавиатуры}. Сбрасываются при изменении избранного
+FAVORITE_MARCUP_CACHE_SIZE = settings.session_cache_size
+_favorite_marcups: OrderedDict = OrderedDict()
+_favorite_marcups_lock = threading.Lock()
+# Поколения избранного: {chat_id: номер}. Номер растёт при каждом изменении избранного, и меню, собранное
+# до изменения, не попадает в кэш
+_favorite_generations: dict = {}
+
+
+@lru_cache(maxsize=None)
+def get_main_reply_marcup() -> str:
+    """
+    Возвращает клавиатуру главного меню под полем ввода.
+
+    :return: JSON клавиатуры для reply_markup
     """
-    Отправляет меню для выбора первой станции.
+    markup = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
+    main_menu_button = types.KeyboardButton("Главное меню 📝")
+    settings_button = types.KeyboardButton("Настройки 🛠")
+    feedback_button = types.KeyboardButton("Обратная связь ☺️")
+
+    markup.add(main_menu_button)
+    markup.row(feedback_button, settings_button)
+
+    return markup.to_json()
+
+
+@lru_cache(maxsize=None)
+def get_station_menu_marcup(add_to_callback: str, button_text: str, button_callback: str,
+                            selected_station: str = None) -> str:
+    """
+    Возвращает меню выбора станции с дополнительной кнопкой под станциями. Станций всего 9, поэтому
+    вариантов меню немного: каждый собирается один раз и дальше отдаётся готовым JSON.
+
+    :param add_to_callback: Строка для добавления к данным callback
+    :param button_text: Текст дополнительной кнопки
+    :param button_callback: Данные callback дополнительной кнопки
+    :param selected_station: Уже выбранная первая станция. Если не передана - меню выбора первой станции
+    :return: JSON клавиатуры для reply_markup
+    """
+    if selected_station is None:
+        markup = get_first_station_marcup(add_to_callback)
+    else:
+        markup = get_second_station_marcup(add_to_callback, selected_station)
+    markup.add(types.InlineKeyboardButton(button_text, callback_data=button_callback))
+
+    return markup.to_json()
+
+
+@lru_cache(maxsize=None)
+def get_settings_marcup(current_count_trains: int = None) -> str:
+    """
+    Возвращает меню выбора количества поездов с отмеченным текущим значением.
+
+    :param current_count_trains: Текущее количество поездов пользователя
+    :return: JSON клавиатуры для reply_markup
+    """
+    markup = types.InlineKeyboardMarkup()
+
+    first_line = []
+    second_line = []
+    for i in range(1, 11):
+        if i != current_count_trains:
+            button = types.InlineKeyboardButton(str(num_translator.get(i)), callback_data=str(i))
+        else:
+            button = types.InlineKeyboardButton("✅", callback_data="pass")
+
+        if len(first_line) < 5:
+            first_line.append(button)
+        else:
+            second_line.append(button)
+
+    markup.row(*first_line)
+    markup.row(*second_line)
+
+    return markup.to_json()
+
+
+@lru_cache(maxsize=None)
+def get_confirm_remove_trip_marcup() -> str:
+    """
+    Возвращает меню подтверждения удаления маршрута.
+
+    :return: JSON клавиатуры для reply_markup
+    """
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("✅ Да", callback_data="confirm_delete"))
+    markup.add(types.InlineKeyboardButton("❌ Нет", callback_data="draw_remove_favorite_trip_menu"))
+
+    return markup.to_json()
+
+
+def get_favorite_trips_menu_marcup(message, add_to_callback: str) -> str:
+    """
+    Возвращает меню избранных маршрутов пользователя. Меню собирается при первом показе
+    и хранится до изменения избранного.
 
     :param message: Объект сообщения от пользователя
+    :param add_to_callback: Строка для добавления к данным callback ("favorite_" или "remove_")
+    :return: JSON клавиатуры для reply_markup
     """
-    markup = get_first_station_marcup("start_")
+    key = (message.chat.id, add_to_callback)
+    with _favorite_marcups_lock:
+        cached_marcup = _favorite_marcups.get(key)
+        if cached_marcup is not None:
+            _favorite_marcups.move_to_end(key)
+            return cached_marcup
+        generation = _favorite_generations.get(message.chat.id, 0)
 
-    favorite_trips_menu_button = types.InlineKeyboardButton("✨ Избранные маршруты ✨",
-                                                            callback_data="go_to_favorite_trips_menu")
-    markup.add(favorite_trips_menu_button)
+    markup = get_favorite_trips_marcup(message, add_to_callback)
+    for row in favorite_trips_menu_buttons[add_to_callback]:
+        markup.row(*[types.InlineKeyboardButton(text, callback_data=callback) for text, callback in row])
+    marcup_json = markup.to_json()
 
-    main_bot.send_message(message.chat.id, "С какой станции планируете уехать? 🗺",
-                          reply_markup=markup)
+    with _favorite_marcups_lock:
+        # Пока меню собиралось, избранное могло измениться в другом потоке: такое меню не сохраняется
+        if _favorite_generations.get(message.chat.id, 0) == generation:
+            _favorite_marcups[key] = marcup_json
+            if len(_favorite_marcups) > FAVORITE_MARCUP_CACHE_SIZE:
+                _favorite_marcups.popitem(last=False)
 
+    return marcup_json
 
-def redraw_first_station_menu(message):
+
+def invalidate_favorite_trips_marcup(chat_id: int):
     """
-    Перерисовывает меню для выбора первой станции.
+    Сбрасывает сохранённые меню избранных маршрутов пользователя.
+
+    :param chat_id: ID пользователя
+    """
+    with _favorite_marcups_lock:
+        _favorite_generations[chat_id] = _favorite_generations.get(chat_id, 0) + 1
+        for add_to_callback in favorite_trips_menu_buttons:
+            _favorite_marcups.pop((chat_id, add_to_callback), None)
+
+
+def change_favorite_trips(change, chat_id: int, trip: str) -> bool:
+    """
+    Изменяет избранные маршруты пользователя и сбрасывает его сохранённые меню.
+    Все изменения избранного проходят через эту функцию, чтобы меню не расходилось с базой данных.
+
+    :param change: Функция изменения избранного (add_favorite_trip или remove_favorite_trip)
+    :param chat_id: ID пользователя
+    :param trip: Маршрут в формате "станция->станция"
+    :return: True, если избранное изменилось
+    """
+    try:
+        return change(chat_id, trip)
+    finally:
+        invalidate_favorite_trips_marcup(chat_id)
+
+
+def build_keyboards():
+    """
+    Заранее собирает все общие клавиатуры, чтобы первые пользователи после запуска не ждали их сборки.
+    """
+    get_main_reply_marcup()
+    get_confirm_remove_trip_marcup()
+
+    for count_trains in [None, *range(1, 11)]:
+        get_settings_marcup(count_trains)
+
+    for menu in (FIRST_STATION_MENU, ADD_TRIP_STEP_ONE_MENU):
+        get_station_menu_marcup(*menu)
+    for menu in (SECOND_STATION_MENU, ADD_TRIP_STEP_TWO_MENU):
+        for selected_station in station_button_names:
+            get_station_menu_marcup(*menu, selected_station)
+
+
+def send_first_station_menu(message):
+    """
+    Отправляет меню для выбора первой станции.
 
     :param message: Объект сообщения от пользователя
     """
-    markup = get_first_station_marcup("start_")
+    queue_send_message(main_bot, message.chat.id, "С какой станции планируете уехать? 🗺",
+                       reply_markup=get_station_menu_marcup(*FIRST_STATION_MENU))
+
 
-    favorite_trips_menu_button = types.InlineKeyboardButton("✨ Избранные маршруты ✨",
-                                                            callback_data="go_to_favorite_trips_menu")
-    markup.add(favorite_trips_menu_button)
+def redraw_first_station_menu(message):
+    """
+    Перерисовывает меню для выбора первой станции.
 
-    main_bot.edit_message_text("С какой станции планируете уехать? 🗺", message.chat.id, message.message_id,
-                               reply_markup=markup)
+    :param message: Объект сообщения от пользователя
+    """
+    queue_edit_message_text(main_bot, "С какой станции планируете уехать? 🗺", message.chat.id, message.message_id,
+                            reply_markup=get_station_menu_marcup(*FIRST_STATION_MENU))
 
 
 def draw_second_station_menu(message, selected_station: str):
@@ -368,13 +614,8 @@ def draw_second_station_menu(message, selected_station: str):
     :param message: Объект сообщения от пользователя
     :param selected_station: выбранная пользователем первая станция
     """
-    markup = get_second_station_marcup("finish_", selected_station)
-
-    back_button = types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_first_station_menu")
-    markup.add(back_button)
-
-    main_bot.edit_message_text("На какую станцию планируете попасть? ⛔", message.chat.id, message.message_id,
-                               reply_markup=markup)
+    queue_edit_message_text(main_bot, "На какую станцию планируете попасть? ⛔", message.chat.id, message.message_id,
+                            reply_markup=get_station_menu_marcup(*SECOND_STATION_MENU, selected_station))
 
 
 def draw_favorite_trips_menu(message):
@@ -383,20 +624,10 @@ def draw_favorite_trips_menu(message):
 
     :param message: Объект сообщения от пользователя
     """
-    markup = get_favorite_trips_marcup(message, "favorite_")
-
-    add_favorite_trip_button = types.InlineKeyboardButton("➕ Добавить маршрут",
-                                                          callback_data="draw_add_favorite_trip_menu_step_one")
-    remove_favorite_trip_button = types.InlineKeyboardButton("➖ Удалить маршрут",
-                                                             callback_data="draw_remove_favorite_trip_menu")
-
-    back_button = types.InlineKeyboardButton("🔙 Назад", callback_data="back_to_first_station_menu")
-    markup.row(remove_favorite_trip_button, add_favorite_trip_button)
-    markup.add(back_button)
-
     favorite_station_message = "📝 Список ваших любимых маршрутов:"
 
-    main_bot.edit_message_text(favorite_station_message, message.chat.id, message.message_id, reply_markup=markup)
+    queue_edit_message_text(main_bot, favorite_station_message, message.chat.id, message.message_id,
+                            reply_markup=get_favorite_trips_menu_marcup(message, "favorite_"))
 
 
 def draw_add_favorite_trip_menu_step_one(message):
@@ -405,10 +636,8 @@ def draw_add_favorite_trip_menu_step_one(message):
 
     :param message: Объект сообщения от пользователя
     """
-    markup = get_first_station_marcup("select_")
-    markup.add(types.InlineKeyboardButton("🔙 Назад", callback_data="go_to_favorite_trips_menu"))
-
-    main_bot.edit_message_text("Выберите начальную станцию: ", message.chat.id, message.message_id, reply_markup=markup)
+    queue_edit_message_text(main_bot, "Выберите начальную станцию: ", message.chat.id, message.message_id,
+                            reply_markup=get_station_menu_marcup(*ADD_TRIP_STEP_ONE_MENU))
 
 
 def draw_add_favorite_trip_menu_step_two(message, selected_station: str):
@@ -418,12 +647,8 @@ def draw_add_favorite_trip_menu_step_two(message, selected_station: str):
     :param message: Объект сообщения от пользователя
     :param selected_station: выбранная пользователем начальная станция
     """
-    markup = get_second_station_marcup("add_", selected_station)
-    back_button = types.InlineKeyboardButton("🔙 Назад", callback_data="draw_add_favorite_trip_menu_step_one")
-    markup.add(back_button)
-
-    main_bot.edit_message_text("Выберите конечную станцию: ", message.chat.id, message.message_id,
-                               reply_markup=markup)
+    queue_edit_message_text(main_bot, "Выберите конечную станцию: ", message.chat.id, message.message_id,
+                            reply_markup=get_station_menu_marcup(*ADD_TRIP_STEP_TWO_MENU, selected_station))
 
 
 def draw_remove_favorite_trip_menu(message):
@@ -432,12 +657,9 @@ def draw_remove_favorite_trip_menu(message):
 
     :param message: Объект сообщения от пользователя
     """
-    markup = get_favorite_trips_marcup(message, "remove_")
-    back_button = types.InlineKeyboardButton("🔙 Назад", callback_data="go_to_favorite_trips_menu")
-    markup.add(back_button)
-
     remove_favorite_trip_message = "Выберите маршрут для удаления❌"
-    main_bot.edit_message_text(remove_favorite_trip_message, message.chat.id, message.message_id, reply_markup=markup)
+    queue_edit_message_text(main_bot, remove_favorite_trip_message, message.chat.id, message.message_id,
+                            reply_markup=get_favorite_trips_menu_marcup(message, "remove_"))
 
 
 def draw_confirm_remove_trip_menu(message):
@@ -446,25 +668,35 @@ def draw_confirm_remove_trip_menu(message):
 
     :param message: Объект сообщения от пользователя
     """
-    markup = types.InlineKeyboardMarkup()
-    markup.add(types.InlineKeyboardButton("✅ Да", callback_data="confirm_delete"))
-    markup.add(types.InlineKeyboardButton("❌ Нет", callback_data="draw_remove_favorite_trip_menu"))
-
     trip_to_remove = get_current_user(message.chat.id).get("selected_trip_to_remove")
 
     confirm_remove_trip_message = ("⁉ Вы уверены, что хотите удалить этот маршрут:\n"
                                    f"{station_button_names.get(trip_to_remove.split('->')[0])} ➜ "
                                    f"{station_button_names.get(trip_to_remove.split('->')[1])}")
 
-    main_bot.edit_message_text(confirm_remove_trip_message, message.chat.id, message.message_id, reply_markup=markup)
+    queue_edit_message_text(main_bot, confirm_remove_trip_message, message.chat.id, message.message_id,
+                            reply_markup=get_confirm_remove_trip_marcup())
 
 
 if __name__ == '__main__':
-    if datetime.date.today().day == 1:
-        update_all_links()
-
-    if datetime.date.today().weekday() == 0:
-        update_schedule_pages()
-        update_schedule_json()
-
-    main_bot.infinity_polling()
+    # Создаёт недостающие таблицы и переносит избранные маршруты в таблицу FavoriteTrips
+    create_table()
+
+    # Общие клавиатуры собираются один раз при запуске и дальше отправляются готовым JSON
+    build_keyboards()
+
+    # Ссылки, страницы и расписание обновляются в фоновом потоке, запуск бота их не ждёт
+    start_schedule_updater(settings.links_refresh_interval, settings.pages_refresh_interval,
+                           settings.refresh_check_interval)
+
+    if settings.mode == "webhook":
+        from WebhookServer import run_webhook_bot
+        run_webhook_bot(main_bot)
+    elif settings.runtime == "async":
+        # aiohttp нужен только асинхронному режиму, поэтому модуль импортируется при выборе этого режима
+        from AsyncRuntime import run_async_bot
+        run_async_bot(main_bot)
+    else:
+        # После работы в режиме webhook Telegram отвечает 409 на каждый getUpdates, пока вебхук не удалён
+        main_bot.delete_webhook()
+        main_bot.infinity_polling()
@@ -0,0 +1,108 @@
+from contextlib import contextmanager
+import threading
+import datetime
+import time
+import pytz
+
+from Config import get_settings
+
+TIMEZONE_NAME = get_settings().timezone
+MINUTES_IN_DAY = 24 * 60
+
+# Смещение часового пояса пересчитывается не чаще раза в сутки
+OFFSET_TTL = 24 * 60 * 60
+
+_clock_lock = threading.Lock()
+_timezone = pytz.timezone(TIMEZONE_NAME)
+# Кортеж (UTC timestamp, до которого смещение актуально, смещение в секундах)
+_offset_cache = (float("-inf"), 0)
+# Источник текущего UTC timestamp. Подменяется для тестов и замеров
+_time_source = time.time
+
+
+def _get_offset(timestamp: float) -> int:
+    """
+    Функция возвращает смещение часового пояса Екатеринбурга от UTC, пересчитывая его только после истечения OFFSET_TTL
+    :param timestamp: UTC timestamp
+    :return: Смещение в секундах
+    """
+    global _offset_cache
+
+    valid_until, offset = _offset_cache
+    if timestamp < valid_until:
+        return offset
+
+    utc_time = datetime.datetime.fromtimestamp(timestamp, pytz.utc)
+    offset = int(utc_time.astimezone(_timezone).utcoffset().total_seconds())
+    _offset_cache = (timestamp + OFFSET_TTL, offset)
+    return offset
+
+
+def get_local_timestamp() -> float:
+    """
+    Функция один раз читает текущее время и переводит его во время Екатеринбурга
+    :return: Количество секунд с начала эпохи по местному времени
+    """
+    timestamp = _time_source()
+    return timestamp + _get_offset(timestamp)
+
+
+def now() -> datetime.datetime:
+    """
+    Функция возвращает текущие дату и время в Екатеринбурге
+    :return: Объект datetime.datetime без часового пояса в местном времени
+    """
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=get_local_timestamp())
+
+
+def today() -> datetime.date:
+    """
+    Функция возвращает текущую дату в Екатеринбурге
+    :return: Дата в формате datetime.date
+    """
+    return datetime.date.fromordinal(datetime.date(1970, 1, 1).toordinal() + int(get_local_timestamp() // 86400))
+
+
+def get_minute_of_day() -> int:
+    """
+    Функция возвращает текущее время в Екатеринбурге в минутах с начала суток
+    :return: Время в формате (Часы * 60 + Минуты)
+    """
+    return int(get_local_timestamp() // 60) % MINUTES_IN_DAY
+
+
+def set_time_source(time_source=None):
+    """
+    Функция подменяет источник текущего времени. Без аргументов возвращает системные часы
+    :param time_source: Функция без аргументов, возвращающая UTC timestamp
+    """
+    global _time_source, _offset_cache
+
+    with _clock_lock:
+        _time_source = time_source or time.time
+        _offset_cache = (float("-inf"), 0)
+
+
+def freeze_time(moment: datetime.datetime):
+    """
+    Функция останавливает часы на переданном моменте. Время без часового пояса считается временем Екатеринбурга
+    :param moment: Момент времени в формате datetime.datetime
+    """
+    if moment.tzinfo is None:
+        moment = _timezone.localize(moment)
+    timestamp = moment.timestamp()
+    set_time_source(lambda: timestamp)
+
+
+@contextmanager
+def frozen_time(moment: datetime.datetime):
+    """
+    Контекстный менеджер, останавливающий часы на переданном моменте на время выполнения блока
+    :param moment: Момент времени в формате datetime.datetime
+    """
+    previous_source = _time_source
+    freeze_time(moment)
+    try:
+        yield
+    finally:
+        set_time_source(previous_source)
@@ -1,19 +1,18 @@
-from os import sep
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left
+from operator import sub
+import threading
 import datetime
+import csv
+import io
 import pytz
-import json
-
-station_priority = {
-    "Kosmonavtov_Avenue": 0,
-    "Uralmash": 1,
-    "Mashinostroiteley": 2,
-    "Uralskaya": 3,
-    "Dinamo": 4,
-    "Square_of_1905": 5,
-    "Geologicheskaya": 6,
-    "Chkalovskaya": 7,
-    "Botanicheskaya": 8
-}
+
+from MetroClock import get_minute_of_day, today, TIMEZONE_NAME
+from WorkCalendar import get_day_type
+from ScheduleStore import (get_station_schedule, get_next_departures, get_schedule_version, get_trip_table, get_trip,
+                           MINUTES_IN_DAY)
+from Config import get_settings
 
 station_translator = {
     "Kosmonavtov_Avenue": "Проспект Космонавтов",
@@ -27,39 +26,12 @@ station_translator = {
     "Botanicheskaya": "Ботаническая"
 }
 
-
-def get_day_type(date: datetime.date = None) -> str:
-    """
-    Функция проверяет переданную дату на принадлежность к выходному или рабочему дням.
-    В случае, если дата не была передана - использует текущую
-    :param date: дата в формате datetime.date
-    :return: Возвращает "Выходные", если переданная дата является выходным днём, и "Рабочие", если это рабочий день
-    """
-    if date is None:
-        date = datetime.date.today()
-
-    non_weekends = [
-        datetime.date(2024, 11, 2),
-        datetime.date(2024, 12, 28)
-    ]
-
-    weekends = [
-        datetime.date(2024, 5, 9),
-        datetime.date(2024, 5, 10),
-        datetime.date(2024, 6, 12),
-        datetime.date(2024, 11, 4),
-        datetime.date(2024, 12, 30),
-        datetime.date(2024, 12, 31)
-    ]
-
-    if date in non_weekends:
-        return "Рабочие"
-    elif date in weekends:
-        return "Выходные"
-    elif date.weekday() >= 5:
-        return "Выходные"
-    else:
-        return "Рабочие"
+# Готовые сообщения с расписанием. Кэш очищается при смене минуты и при перезагрузке расписания
+RESPONSE_CACHE_SIZE = get_settings().response_cache_size
+_response_cache: OrderedDict = OrderedDict()
+_response_cache_generation = None
+_response_cache_lock = threading.Lock()
+_response_cache_stats = {"hits": 0, "misses": 0}
 
 
 def get_current_time() -> int:
@@ -67,11 +39,7 @@ def get_current_time() -> int:
     Функция возвращает текущее время для временной зоны Екатеринбурга
     :return: Время в формате (Часы * 60 + Минуты)
     """
-    hours = int(datetime.datetime.now(pytz.utc).strftime("%H")) + 5
-    if hours >= 25:
-        hours -= 24
-    minutes = int(datetime.datetime.now().strftime("%M"))
-    return hours * 60 + minutes
+    return get_minute_of_day()
 
 
 def get_formatted_time(time: int) -> str:
@@ -93,6 +61,14 @@ def get_formatted_time(time: int) -> str:
     return f"{hour}:{minute}"
 
 
+# Заранее отформатированные времена для всех минут двух суток. Позволяют форматировать целые массивы
+# через map без вызова Python-функции на каждый элемент
+_formatted_times = tuple(get_formatted_time(time % MINUTES_IN_DAY) for time in range(2 * MINUTES_IN_DAY))
+_ics_times = tuple(f"T{time % MINUTES_IN_DAY // 60:02}{time % 60:02}00" for time in range(2 * MINUTES_IN_DAY))
+# Максимальная длина строки iCalendar в октетах без CRLF (RFC 5545, 3.1)
+ICS_LINE_LIMIT = 75
+
+
 def get_schedule(station_name, day_type, direction) -> list:
     """
     Функция возвращает расписание поездов для требуемых станции, типа дня и направления
@@ -101,64 +77,251 @@ def get_schedule(station_name, day_type, direction) -> list:
     :param direction: Направление (Ботаническая/Проспект космонавтов)
     :return: Массив с расписанием поездов
     """
-    with open(f"ScheduleDB{sep}schedule.json", "r", encoding="utf-8") as file:
-        schedule: dict = json.load(file)
-        return schedule.get(station_name, {}).get(day_type, {}).get(direction)
+    return get_station_schedule(station_name, day_type, direction)
+
+
+def render_closest_trains(start_station: str, finish_station: str, start_times, finish_times,
+                          current_time: int) -> str:
+    """
+    Функция формирует сообщение со списком ближайших поездов
+    :param start_station: Название начальной станции
+    :param finish_station: Название конечной станции
+    :param start_times: Времена отправления ближайших поездов
+    :param finish_times: Времена прибытия ближайших поездов
+    :param current_time: Время в формате (Часы * 60 + Минуты), от которого считается время до отправления
+    :return: Сообщение с перечислением поездов
+    """
+    lines = ["Список ближайших 🚇 по маршруту\n"
+             f"<u><i><b>"
+             f"{station_translator.get(start_station)} ➜ {station_translator.get(finish_station)}:"
+             f"</b></i></u>\n"]
+
+    if start_times:
+        lines.append(f"<u><i>Время в пути составит {finish_times[0] - start_times[0]} минут(ы)</i></u>\n")
+        lines.append(f"\n<b>1. {get_formatted_time(start_times[0])} ➜ {get_formatted_time(finish_times[0])} - ⏳ "
+                     f"до отправления осталось {(start_times[0] - current_time) % MINUTES_IN_DAY} минут(ы).</b>\n")
+
+    for k in range(1, len(start_times)):
+        lines.append(f"\n<i>{k + 1}. {get_formatted_time(start_times[k])} ➜ {get_formatted_time(finish_times[k])} - "
+                     f"до отправления осталось {(start_times[k] - current_time) % MINUTES_IN_DAY} минут(ы).</i>\n")
+
+    return "".join(lines)
 
 
 def get_closest_trains(start_station: str, finish_station: str, count_trains: int) -> str:
     """
     Функция возвращает сообщение со списком ближайших поездов по параметрам.
+    Сообщение зависит только от маршрута, количества поездов, типа дня и текущей минуты,
+    поэтому повторные запросы в течение одной минуты отдаются из кэша
     :param start_station: Название начальной станции
     :param finish_station: Название конечной станции
     :param count_trains: Требуемое количество поездов
     :return: Сообщение с перечислением поездов
     """
+    global _response_cache_generation
 
-    start_times, finish_times = [], []
-    message = ("Список ближайших 🚇 по маршруту\n"
-               f"<u><i><b>"
-               f"{station_translator.get(start_station)} ➜ {station_translator.get(finish_station)}:"
-               f"</b></i></u>\n")
+    current_time = get_current_time()
+    day_type = get_day_type()
+    generation = (current_time, get_schedule_version())
+    key = (start_station, finish_station, count_trains, day_type, current_time)
 
-    # Так как расписания для "Ботаническая -> Ботаническая" и "Космонавтов -> Космонавтов" не существует,
-    # время до прибытия на эти станции считается как время до предыдущей станции + 2 минуты.
-    was_changed = False
-    if finish_station == "Botanicheskaya":
-        finish_station = "Chkalovskaya"
-        was_changed = True
-    elif finish_station == "Kosmonavtov_Avenue":
-        finish_station = "Uralmash"
-        was_changed = True
+    with _response_cache_lock:
+        if generation != _response_cache_generation:
+            _response_cache.clear()
+            _response_cache_generation = generation
 
-    if station_priority.get(start_station) < station_priority.get(finish_station):
-        direction = "Ботаническая"
-    else:
-        direction = "Проспект Космонавтов"
+        message = _response_cache.get(key)
+        if message is not None:
+            _response_cache.move_to_end(key)
+            _response_cache_stats["hits"] += 1
+            return message
+        _response_cache_stats["misses"] += 1
 
-    current_time = get_current_time()
+    start_times, finish_times = get_next_departures(start_station, finish_station, day_type, current_time,
+                                                    count_trains)
+    message = render_closest_trains(start_station, finish_station, start_times, finish_times, current_time)
 
-    start_schedule = get_schedule(start_station, get_day_type(), direction)
-    finish_schedule = get_schedule(finish_station, get_day_type(), direction)
-    for i in range(len(start_schedule)):
-        if start_schedule[i] >= current_time:
-            f_time = finish_schedule[i]
-            if was_changed:
-                f_time += 2
-            message += f"<u><i>Время в пути составит {f_time - start_schedule[i]} минут(ы)</i></u>\n"
-            message += (f"\n<b>1. {get_formatted_time(start_schedule[i])} ➜ {get_formatted_time(f_time)} - ⏳ "
-                        f"до отправления осталось {start_schedule[i] - current_time} минут(ы).</b>\n")
-
-            start_times = start_schedule[i + 1:i + count_trains]
-            finish_times = finish_schedule[i + 1:i + count_trains]
-            break
-
-    for k in range(len(start_times)):
-        f_time = finish_times[k]
-        if was_changed:
-            f_time += 2
-
-        message += (f"\n<i>{k + 2}. {get_formatted_time(start_times[k])} ➜ {get_formatted_time(f_time)} - "
-                    f"до отправления осталось {start_times[k] - current_time} минут(ы).</i>\n")
+    with _response_cache_lock:
+        if generation == _response_cache_generation:
+            _response_cache[key] = message
+            if len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
 
     return message
+
+
+def get_response_cache_stats() -> dict:
+    """
+    Функция возвращает статистику кэша сообщений с расписанием
+    :return: Словарь с количеством попаданий, промахов и текущим размером кэша
+    """
+    with _response_cache_lock:
+        return {**_response_cache_stats, "size": len(_response_cache)}
+
+
+def get_closest_trains_batch(routes: list, current_time: int = None, day_type: str = None) -> list[dict]:
+    """
+    Функция возвращает ближайшие поезда сразу для нескольких маршрутов. Время, тип дня и таблица маршрутов
+    определяются один раз на весь набор, поэтому все маршруты считаются по одной версии расписания
+    :param routes: Массив кортежей (начальная станция, конечная станция, количество поездов)
+    :param current_time: Время в формате (Часы * 60 + Минуты). Если не передано, используется текущее
+    :param day_type: Тип дня (Выходные/Рабочие). Если не передан, определяется по текущей дате
+    :return: Массив словарей с временами отправления, прибытия, временем в пути и готовым сообщением
+        для каждого маршрута в том же порядке
+    """
+    if current_time is None:
+        current_time = get_current_time()
+    if day_type is None:
+        day_type = get_day_type()
+    trip_table = get_trip_table()
+
+    results = []
+    for start_station, finish_station, count_trains in routes:
+        start_times, finish_times = get_next_departures(start_station, finish_station, day_type, current_time,
+                                                        count_trains, trip_table)
+        results.append({
+            "start_station": start_station,
+            "finish_station": finish_station,
+            "departures": list(start_times),
+            "arrivals": list(finish_times),
+            "travel_times": [finish - start for start, finish in zip(start_times, finish_times)],
+            "message": render_closest_trains(start_station, finish_station, start_times, finish_times,
+                                             current_time)
+        })
+
+    return results
+
+
+def get_route_timetable(start_station: str, finish_station: str, day_type: str = None) -> dict:
+    """
+    Функция возвращает расписание маршрута на весь день. Все массивы считаются целиком через map по
+    выровненным массивам отправлений и прибытий, без цикла на Python по каждому поезду
+    :param start_station: Название начальной станции
+    :param finish_station: Название конечной станции
+    :param day_type: Тип дня (Выходные/Рабочие). Если не передан, определяется по текущей дате
+    :return: Словарь с массивами отправлений, прибытий, времени в пути и отформатированных времён
+    """
+    if day_type is None:
+        day_type = get_day_type()
+
+    departures, arrivals = get_trip(start_station, finish_station, day_type)
+
+    return {
+        "start_station": start_station,
+        "finish_station": finish_station,
+        "day_type": day_type,
+        "departures": departures,
+        "arrivals": arrivals,
+        "travel_times": array("H", map(sub, arrivals, departures)),
+        "formatted_departures": list(map(_formatted_times.__getitem__, departures)),
+        "formatted_arrivals": list(map(_formatted_times.__getitem__, arrivals))
+    }
+
+
+def export_route_timetable_csv(start_station: str, finish_station: str, day_type: str = None) -> str:
+    """
+    Функция возвращает расписание маршрута на весь день в формате CSV
+    :param start_station: Название начальной станции
+    :param finish_station: Название конечной станции
+    :param day_type: Тип дня (Выходные/Рабочие). Если не передан, определяется по текущей дате
+    :return: Текст CSV со столбцами "Отправление", "Прибытие", "В пути, мин"
+    """
+    timetable = get_route_timetable(start_station, finish_station, day_type)
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["Отправление", "Прибытие", "В пути, мин"])
+    writer.writerows(zip(timetable["formatted_departures"], timetable["formatted_arrivals"],
+                         timetable["travel_times"]))
+    return output.getvalue()
+
+
+def _fold_ics_line(line: str) -> str:
+    """
+    Функция переносит строку iCalendar длиннее ICS_LINE_LIMIT октетов: продолжение начинается с пробела.
+    Многобайтовые символы UTF-8 не разрываются
+    :param line: Строка без завершающего CRLF
+    :return: Строка с переносами
+    """
+    encoded = line.encode("utf-8")
+    if len(encoded) <= ICS_LINE_LIMIT:
+        return line
+
+    parts = []
+    start, limit = 0, ICS_LINE_LIMIT
+    while len(encoded) - start > limit:
+        end = start + limit
+        # Байты вида 10xxxxxx продолжают многобайтовый символ, перенос ставится перед его началом
+        while encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode("utf-8"))
+        # Пробел в начале строки-продолжения тоже занимает октет
+        start, limit = end, ICS_LINE_LIMIT - 1
+    parts.append(encoded[start:].decode("utf-8"))
+    return "\r\n ".join(parts)
+
+
+def _get_ics_timezone(date: datetime.date) -> str:
+    """
+    Функция описывает часовой пояс бота компонентом VTIMEZONE, на который ссылаются времена событий.
+    Смещение берётся на выбранную дату
+    :param date: Дата в формате datetime.date
+    :return: Текст компонента VTIMEZONE
+    """
+    local_noon = pytz.timezone(TIMEZONE_NAME).localize(datetime.datetime.combine(date, datetime.time(12)))
+    offset_minutes = int(local_noon.utcoffset().total_seconds()) // 60
+    offset = f"{'+' if offset_minutes >= 0 else '-'}{abs(offset_minutes) // 60:02}{abs(offset_minutes) % 60:02}"
+    return ("BEGIN:VTIMEZONE\r\n"
+            f"TZID:{TIMEZONE_NAME}\r\n"
+            "BEGIN:STANDARD\r\n"
+            "DTSTART:19700101T000000\r\n"
+            f"TZOFFSETFROM:{offset}\r\n"
+            f"TZOFFSETTO:{offset}\r\n"
+            f"TZNAME:{local_noon.tzname()}\r\n"
+            "END:STANDARD\r\n"
+            "END:VTIMEZONE\r\n")
+
+
+def export_route_timetable_ics(start_station: str, finish_station: str, date: datetime.date = None) -> str:
+    """
+    Функция возвращает расписание маршрута на выбранную дату в формате iCalendar, по событию на каждый поезд
+    :param start_station: Название начальной станции
+    :param finish_station: Название конечной станции
+    :param date: Дата в формате datetime.date. Если не передана, используется текущая
+    :return: Текст календаря в формате .ics
+    """
+    if date is None:
+        date = today()
+
+    timetable = get_route_timetable(start_station, finish_station, get_day_type(date))
+    departures, arrivals = timetable["departures"], timetable["arrivals"]
+
+    # Поезда после полуночи относятся к следующей календарной дате
+    date_str, next_date_str = date.strftime("%Y%m%d"), (date + datetime.timedelta(days=1)).strftime("%Y%m%d")
+    after_midnight_departures = bisect_left(departures, MINUTES_IN_DAY)
+    after_midnight_arrivals = bisect_left(arrivals, MINUTES_IN_DAY)
+    departure_dates = ([date_str] * after_midnight_departures +
+                       [next_date_str] * (len(departures) - after_midnight_departures))
+    arrival_dates = [date_str] * after_midnight_arrivals + [next_date_str] * (len(arrivals) - after_midnight_arrivals)
+
+    summary = f"{station_translator.get(start_station)} ➜ {station_translator.get(finish_station)}"
+    stamp = datetime.datetime.now(pytz.utc).strftime("%Y%m%dT%H%M%SZ")
+    event_template = ("BEGIN:VEVENT\r\n"
+                      f"UID:{start_station}-{finish_station}-{{0}}{{1}}@EkbMetroScheduleBot\r\n"
+                      f"DTSTAMP:{stamp}\r\n"
+                      f"DTSTART;TZID={TIMEZONE_NAME}:{{0}}{{1}}\r\n"
+                      f"DTEND;TZID={TIMEZONE_NAME}:{{2}}{{3}}\r\n"
+                      f"SUMMARY:🚇 {summary}\r\n"
+                      "END:VEVENT\r\n")
+
+    events = map(event_template.format,
+                 departure_dates, map(_ics_times.__getitem__, departures),
+                 arrival_dates, map(_ics_times.__getitem__, arrivals))
+
+    calendar = ("BEGIN:VCALENDAR\r\n"
+                "VERSION:2.0\r\n"
+                "PRODID:-//EkbMetroScheduleBot//RU\r\n"
+                f"{_get_ics_timezone(date)}"
+                f"{''.join(events)}"
+                "END:VCALENDAR\r\n")
+    return "\r\n".join(map(_fold_ics_line, calendar.split("\r\n")))
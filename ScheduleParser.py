@@ -1,8 +1,56 @@
-from os import sep
+from os import sep, replace
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from array import array
+import multiprocessing
+import threading
+import hashlib
+import logging
+import json
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
-import json
+from lxml import etree
+import lxml.html
+
+from ScheduleStore import dump_schedule_binary, load_schedule, reload_schedule
+
+# На сайте направление к "Проспекту Космонавтов" встречается в разном регистре
+direction_names = {
+    "ботаническая": "Ботаническая",
+    "проспект космонавтов": "Проспект Космонавтов"
+}
+
+logger = logging.getLogger(__name__)
+
+# Параметры загрузки страниц: число параллельных запросов, таймауты (соединение, чтение) и повторы
+FETCH_WORKERS = 4
+REQUEST_TIMEOUT = (5, 20)
+REQUEST_RETRIES = 3
+REQUEST_BACKOFF = 0.5
+
+# Число процессов для разбора страниц. При 1 страницы разбираются последовательно в текущем процессе.
+# В боте значение задаётся настройкой parse_workers
+PARSE_WORKERS = 1
+
+request_headers = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,"
+              "application/signed-exchange;v=b3;q=0.7",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/121.0.0.0Safari/537.36 OPR/107.0.0.0 (Edition Yx GX)"
+}
+
+# Заголовки ETag/Last-Modified и хэш содержимого каждой сохранённой страницы
+PAGES_META_PATH = f"ScheduleDB{sep}AllPages{sep}pages_meta.json"
+
+_session = None
+_session_lock = threading.Lock()
+
+# Таблицы с расписанием и подпись "<тип> дни до "<направление>"" в ближайшем абзаце перед каждой таблицей
+timetable_xpath = etree.XPath("//table[contains(concat(' ', normalize-space(@class), ' '), ' uss_table_black10 ')]")
+label_xpath = etree.XPath("preceding-sibling::p[1]")
 
 names_saved_pages = ["MainPage", "Kosmonavtov_Avenue", "Uralmash", "Mashinostroiteley", "Uralskaya", "Dinamo",
                      "Square_of_1905", "Geologicheskaya", "Chkalovskaya", "Botanicheskaya"]
@@ -18,21 +66,81 @@ def save_page_html(name: str, src: str):
         file.write(src)
 
 
+def get_session() -> requests.Session:
+    """
+    Функция возвращает общую для всех запросов HTTP-сессию с keep-alive соединениями
+    и повтором запросов с экспоненциальной задержкой
+    :return: Объект requests.Session
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=REQUEST_RETRIES, backoff_factor=REQUEST_BACKOFF,
+                          status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+            adapter = HTTPAdapter(pool_connections=FETCH_WORKERS, pool_maxsize=FETCH_WORKERS, max_retries=retry)
+
+            session = requests.Session()
+            session.headers.update(request_headers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+
+        return _session
+
+
+def _get_response(url: str, headers: dict = None) -> requests.Response:
+    """
+    Функция выполняет GET-запрос через общую сессию
+    :param url: Ссылка на страницу
+    :param headers: Дополнительные заголовки запроса
+    :return: Ответ сервера с правильно определённой кодировкой
+    """
+    req = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    req.raise_for_status()
+    # Без charset в заголовках requests считает страницу ISO-8859-1, поэтому кодировка определяется по содержимому
+    if "charset" not in req.headers.get("Content-Type", "").lower():
+        req.encoding = req.apparent_encoding
+    return req
+
+
 def get_src_link(url: str) -> str:
     """
     Функция возвращает html код страницы по её ссылке
     :param url: Ссылка на страницу
     :return: html код страницы
     """
-    headers = {
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,"
-                  "application/signed-exchange;v=b3;q=0.7",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-                      "Chrome/121.0.0.0Safari/537.36 OPR/107.0.0.0 (Edition Yx GX)"
-    }
+    return _get_response(url).text
+
+
+def get_src_hash(src: str) -> str:
+    """
+    Функция возвращает хэш html кода страницы
+    :param src: html код страницы
+    :return: SHA-256 в шестнадцатеричном виде
+    """
+    return hashlib.sha256(src.encode("utf-8")).hexdigest()
 
-    req = requests.get(url, headers=headers)
-    return req.text
+
+def load_pages_meta() -> dict:
+    """
+    Функция возвращает сохранённые заголовки и хэши страниц
+    :return: Словарь {имя страницы: {"url", "etag", "last_modified", "sha256"}}
+    """
+    try:
+        with open(PAGES_META_PATH, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_pages_meta(pages_meta: dict):
+    """
+    Функция сохраняет заголовки и хэши страниц
+    :param pages_meta: Словарь {имя страницы: {"url", "etag", "last_modified", "sha256"}}
+    """
+    with open(PAGES_META_PATH, "w", encoding="utf-8") as file:
+        json.dump(pages_meta, file, indent=4, ensure_ascii=False)
 
 
 def get_src_file(name: str) -> str:
@@ -72,70 +180,240 @@ def update_all_links():
         json.dump(links_dict, file, indent=4, ensure_ascii=False)
 
 
-def update_schedule_pages():
+def download_schedule_pages(links: dict = None,
+                            max_workers: int = FETCH_WORKERS) -> tuple[list[str], dict, list[str]]:
     """
-    Функция обновляет сохранённые страницы с подробным расписанием поездов для всех станций
+    Функция скачивает страницы с подробным расписанием поездов для всех станций и сохраняет изменившиеся.
+    Страницы скачиваются параллельно через общую HTTP-сессию условными запросами (If-None-Match,
+    If-Modified-Since), а страницы с прежним содержимым не перезаписываются.
+    Новые заголовки и хэши не сохраняются: их нужно сохранить после пересборки расписания (save_pages_meta)
+    :param links: Словарь {название станции: ссылка}. По умолчанию читается из файла station_links.json
+    :param max_workers: Максимальное число одновременных запросов
+    :return: Кортеж (имена изменившихся станций, новые заголовки и хэши страниц, имена нескачавшихся станций)
     """
-    with open(f"ScheduleDB{sep}AllPages{sep}station_links.json") as file:
-        links_dict = json.load(file)
+    if links is None:
+        with open(f"ScheduleDB{sep}AllPages{sep}station_links.json") as file:
+            links = json.load(file)
 
-    name_number = 1
-    for name, link in links_dict.items():
-        save_page_html(names_saved_pages[name_number], get_src_link(link))
-        name_number += 1
+    names = names_saved_pages[1:len(links) + 1]
+    urls = list(links.values())
+    pages_meta = load_pages_meta()
+
+    def update_page(name: str, link: str) -> tuple[bool, dict, bool]:
+        """
+        Функция скачивает и сохраняет одну страницу, если она изменилась.
+        Ошибка загрузки одной страницы не мешает остальным
+        :param name: Имя файла
+        :param link: Ссылка на страницу
+        :return: Кортеж (изменилась ли страница, новые заголовки и хэш страницы, не удалось ли скачать страницу)
+        """
+        page_meta = pages_meta.get(name, {})
+
+        headers = {}
+        if page_meta.get("url") == link:
+            if page_meta.get("etag"):
+                headers["If-None-Match"] = page_meta["etag"]
+            if page_meta.get("last_modified"):
+                headers["If-Modified-Since"] = page_meta["last_modified"]
+
+        try:
+            req = _get_response(link, headers)
+        except requests.RequestException:
+            logger.exception("Не удалось скачать страницу %s (%s)", name, link)
+            return False, page_meta, True
+
+        if req.status_code == 304:
+            return False, page_meta, False
+
+        src = req.text
+        new_meta = {
+            "url": link,
+            "etag": req.headers.get("ETag"),
+            "last_modified": req.headers.get("Last-Modified"),
+            "sha256": get_src_hash(src)
+        }
+
+        old_hash = page_meta.get("sha256")
+        if old_hash is None:
+            try:
+                # Переводы строк читаются как есть, иначе хэш не совпадёт с хэшем скачанной страницы
+                with open(f"ScheduleDB{sep}AllPages{sep}{name}.html", "r", encoding="utf-8", newline="") as file:
+                    old_hash = get_src_hash(file.read())
+            except FileNotFoundError:
+                pass
+
+        if new_meta["sha256"] == old_hash:
+            return False, new_meta, False
+
+        save_page_html(name, src)
+        return True, new_meta, False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(update_page, names, urls))
+
+    new_pages_meta = dict(pages_meta)
+    for name, (_, page_meta, _) in zip(names, results):
+        new_pages_meta[name] = page_meta
+
+    changed = [name for name, (is_changed, _, _) in zip(names, results) if is_changed]
+    failed = [name for name, (_, _, is_failed) in zip(names, results) if is_failed]
+    logger.info("Изменились страницы станций: %s", ", ".join(changed) or "нет")
+    if failed:
+        logger.warning("Не удалось скачать страницы станций: %s", ", ".join(failed))
+    return changed, new_pages_meta, failed
+
+
+def update_schedule_pages(links: dict = None, max_workers: int = FETCH_WORKERS) -> list[str]:
+    """
+    Функция обновляет сохранённые страницы с подробным расписанием поездов для всех станций
+    и сразу сохраняет их новые заголовки и хэши
+    :param links: Словарь {название станции: ссылка}. По умолчанию читается из файла station_links.json
+    :param max_workers: Максимальное число одновременных запросов
+    :return: Массив имён станций, страницы которых изменились
+    """
+    changed, pages_meta, _ = download_schedule_pages(links, max_workers)
+    save_pages_meta(pages_meta)
+    return changed
 
 
-def update_schedule_json():
+def get_schedule_diff(old_schedule: dict, new_schedule: dict) -> list[str]:
+    """
+    Функция сравнивает два расписания и описывает, какие массивы изменились
+    :param old_schedule: Прежнее расписание {станция: {тип дня: {направление: [времена]}}}
+    :param new_schedule: Новое расписание в том же формате
+    :return: Массив строк вида "станция / тип дня / направление: было N поездов, стало M, изменено времён K"
     """
-    Функция записывает расписание поездов для каждой станции в файл "ScheduleDB/schedule.json"
+    report = []
+    for station_name in sorted(old_schedule.keys() | new_schedule.keys()):
+        old_days, new_days = old_schedule.get(station_name, {}), new_schedule.get(station_name, {})
+        for day_type in sorted(old_days.keys() | new_days.keys()):
+            old_directions, new_directions = old_days.get(day_type, {}), new_days.get(day_type, {})
+            for direction in sorted(old_directions.keys() | new_directions.keys()):
+                old_times = list(old_directions.get(direction, []))
+                new_times = list(new_directions.get(direction, []))
+                if old_times != new_times:
+                    changed_times = (sum(old != new for old, new in zip(old_times, new_times))
+                                     + abs(len(old_times) - len(new_times)))
+                    report.append(f"{station_name} / {day_type} / {direction}: было {len(old_times)} поездов, "
+                                  f"стало {len(new_times)}, изменено времён {changed_times}")
+    return report
+
+
+def parse_station_page(name: str) -> dict:
     """
+    Функция разбирает сохранённую страницу станции и возвращает её расписание.
+    Страница разбирается напрямую через lxml, XPath-запросы выбирают только таблицы с расписанием и их подписи
+    :param name: Имя файла страницы станции
+    :return: Словарь {тип дня: {направление: [времена]}}
+    """
+    station_schedule = {}
 
-    schedule = {}
+    tree = lxml.html.fromstring(get_src_file(name))
 
-    def update_schedule(start_station: str, day: str, way: str, train_times: list):
-        """
-        Функция добавляет в словарь необходимый массив с расписанием поездов
-        :param start_station: Название начальной станции
-        :param day: Тип дня (выходной или рабочий)
-        :param way: Название конечной станции (Проспект Космонавтов или Ботаническая)
-        :param train_times: Массив с временами отправления поездов со станции
-        """
-        if start_station not in schedule:
-            schedule[start_station] = {}
-        if day not in schedule[start_station]:
-            schedule[start_station][day] = {}
-        schedule[start_station][day][way] = train_times
+    for table in timetable_xpath(tree):
+        label = label_xpath(table)[0].text_content().strip()
+
+        day_type, direction = label.split(" дни ")[0], label.split('"')[1]
+        direction = direction_names.get(direction.lower(), direction)
+
+        trains = []
+        for row in table.iter("tr"):
+            cells = row.findall(".//td")
+            if len(cells) < 2:
+                continue
+
+            hour_str, minutes_str = cells[0].text_content().strip(), cells[1].text_content().strip()
+            if not hour_str.isdigit():
+                continue
+
+            hour = int(hour_str)
+            if hour == 0:
+                hour = 24
 
-    for name in names_saved_pages:
+            if not minutes_str[-1].isdigit():
+                minutes_str = minutes_str[:-1]
 
-        soup = BeautifulSoup(get_src_file(name), "lxml")
+            for minute in minutes_str.split(";"):
+                trains.append(hour * 60 + int(minute))
 
-        tables = soup.find_all('table', class_='uss_table_black10')
+        station_schedule.setdefault(day_type, {})[direction] = trains
 
-        for table in tables:
-            label = table.find_previous_sibling('p').text.strip()
+    return station_schedule
 
-            day_type, direction = label.split(" дни ")[0], label.split('"')[1]
 
-            trains = []
-            rows = table.find_all('tr')
-            for row in rows[1:]:
-                cells = row.find_all('td')
+def parse_station_page_compact(name: str) -> tuple[str, dict]:
+    """
+    Функция разбирает страницу станции и упаковывает времена в array('H'). Используется в процессах-обработчиках,
+    чтобы в родительский процесс передавались компактные массивы
+    :param name: Имя файла страницы станции
+    :return: Кортеж (имя станции, {тип дня: {направление: array('H')}})
+    """
+    return name, {
+        day_type: {direction: array("H", train_times) for direction, train_times in directions.items()}
+        for day_type, directions in parse_station_page(name).items()
+    }
 
-                hour = int(cells[0].text.strip())
-                if hour == 0:
-                    hour = 24
 
-                minutes_str = cells[1].text.strip()
-                if minutes_str[-1] in ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]:
-                    minutes = [int(item) for item in cells[1].text.strip().split(";")]
-                else:
-                    minutes = [int(item) for item in cells[1].text.strip()[:-1].split(";")]
+def parse_station_pages(stations: list, workers: int = PARSE_WORKERS) -> dict:
+    """
+    Функция разбирает страницы нескольких станций. При workers > 1 страницы распределяются по пулу процессов,
+    чтобы разбор не занимал процесс бота. Процессы запускаются через spawn: разбор вызывается из фонового потока,
+    а fork многопоточного процесса может унаследовать захваченные блокировки. Если пул запустить не удалось,
+    страницы разбираются последовательно
+    :param stations: Массив имён станций
+    :param workers: Число процессов
+    :return: Словарь {станция: {тип дня: {направление: массив времён}}}
+    """
+    if workers > 1 and len(stations) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(stations)),
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                return dict(executor.map(parse_station_page_compact, stations))
+        except (OSError, NotImplementedError, BrokenProcessPool):
+            logger.exception("Не удалось разобрать страницы в пуле процессов, разбор идёт последовательно")
 
-                for minute in minutes:
-                    trains.append(hour * 60 + minute)
+    return {name: parse_station_page(name) for name in stations}
 
-            update_schedule(name, day_type, direction, trains)
 
-    with open(f"ScheduleDB{sep}schedule.json", 'w', encoding='utf-8') as file:
-        json.dump(schedule, file, ensure_ascii=False, indent=4)
+def update_schedule_json(stations: list = None, workers: int = PARSE_WORKERS) -> list[str]:
+    """
+    Функция записывает расписание поездов для каждой станции в файлы "ScheduleDB/schedule.json"
+    и "ScheduleDB/schedule.bin" и подменяет расписание в памяти работающего бота.
+    Если переданы станции, разбираются только их страницы, а остальное расписание берётся из текущего
+    :param stations: Массив имён станций для пересборки. По умолчанию пересобираются все станции
+    :param workers: Число процессов для разбора страниц (см. parse_station_pages)
+    :return: Отчёт об изменившихся массивах расписания (см. get_schedule_diff)
+    """
+    try:
+        old_schedule = {
+            station_name: {
+                day_type: {direction: list(train_times) for direction, train_times in directions.items()}
+                for day_type, directions in days.items()
+            }
+            for station_name, days in load_schedule().items()
+        }
+    except FileNotFoundError:
+        old_schedule = {}
+
+    if stations is None:
+        schedule = {}
+        stations = names_saved_pages[1:]
+    else:
+        schedule = dict(old_schedule)
+
+    schedule.update(parse_station_pages(stations, workers))
+
+    report = get_schedule_diff(old_schedule, schedule)
+    logger.info("Изменения в расписании:\n%s", "\n".join(report) or "нет")
+
+    # Запись через временный файл и переименование: работающий бот никогда не прочитает файл наполовину
+    temp_path = f"ScheduleDB{sep}schedule.json.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(schedule, file, ensure_ascii=False, indent=4, default=list)
+    replace(temp_path, f"ScheduleDB{sep}schedule.json")
+
+    # Бот работает с бинарным файлом, JSON остаётся для просмотра и отладки
+    dump_schedule_binary(schedule)
+    reload_schedule()
+
+    return report
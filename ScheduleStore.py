@@ -0,0 +1,320 @@
+from os import sep, stat, replace
+from array import array
+from bisect import bisect_left
+import threading
+import struct
+import json
+import mmap
+import sys
+
+SCHEDULE_JSON_PATH = f"ScheduleDB{sep}schedule.json"
+SCHEDULE_BINARY_PATH = f"ScheduleDB{sep}schedule.bin"
+MINUTES_IN_DAY = 24 * 60
+
+# Формат schedule.bin: префикс (сигнатура, версия, длина заголовка), JSON-заголовок с индексом массивов
+# [станция, тип дня, направление, смещение, длина] и следом все времена подряд в виде uint16
+BINARY_MAGIC = b"MSCH"
+BINARY_VERSION = 1
+_binary_prefix = struct.Struct("<4sHI")
+# В Windows файл, отображённый в память, нельзя заменить через os.replace, пока отображение открыто,
+# а старое расписание может ещё читаться запросами. Поэтому там файл не отображается, а читается в память целиком
+MMAP_SCHEDULE = sys.platform != "win32"
+
+station_priority = {
+    "Kosmonavtov_Avenue": 0,
+    "Uralmash": 1,
+    "Mashinostroiteley": 2,
+    "Uralskaya": 3,
+    "Dinamo": 4,
+    "Square_of_1905": 5,
+    "Geologicheskaya": 6,
+    "Chkalovskaya": 7,
+    "Botanicheskaya": 8
+}
+
+# Так как расписания для "Ботаническая -> Ботаническая" и "Космонавтов -> Космонавтов" не существует,
+# время до прибытия на эти станции считается как время до предыдущей станции + 2 минуты.
+terminal_neighbours = {
+    "Botanicheskaya": "Chkalovskaya",
+    "Kosmonavtov_Avenue": "Uralmash"
+}
+TERMINAL_TRAVEL_TIME = 2
+
+_schedule_lock = threading.Lock()
+# Расписание и построенная по нему таблица маршрутов подменяются одним присваиванием кортежа
+_snapshot: tuple[dict, dict] = ({}, {})
+# Путь и время изменения файла, из которого загружено текущее расписание
+_schedule_source = None
+_schedule_version = 0
+
+
+def _get_source():
+    """
+    Функция выбирает файл, из которого загружается расписание. Бинарный файл имеет приоритет,
+    JSON используется, только если бинарного файла ещё нет
+    :return: Кортеж (путь к файлу, время изменения в наносекундах) или (None, None), если файлов нет
+    """
+    for path in (SCHEDULE_BINARY_PATH, SCHEDULE_JSON_PATH):
+        try:
+            return path, stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+    return None, None
+
+
+def dump_schedule_binary(schedule: dict, path: str = SCHEDULE_BINARY_PATH):
+    """
+    Функция записывает расписание в компактный бинарный файл. Запись идёт через временный файл,
+    поэтому работающий бот никогда не прочитает файл наполовину
+    :param schedule: Словарь с расписанием {станция: {тип дня: {направление: [времена]}}}
+    :param path: Путь к бинарному файлу
+    """
+    index = []
+    minutes = array("H")
+    for station_name, days in schedule.items():
+        for day_type, directions in days.items():
+            for direction, train_times in directions.items():
+                index.append([station_name, day_type, direction, len(minutes), len(train_times)])
+                minutes.extend(train_times)
+
+    header = json.dumps({"byteorder": sys.byteorder, "index": index}, ensure_ascii=False).encode("utf-8")
+    # Выравнивание начала массива времён по границе uint16
+    header += b" " * (len(header) % 2)
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(_binary_prefix.pack(BINARY_MAGIC, BINARY_VERSION, len(header)))
+        file.write(header)
+        minutes.tofile(file)
+    replace(temp_path, path)
+
+
+def load_schedule_binary(path: str = SCHEDULE_BINARY_PATH) -> dict:
+    """
+    Функция отображает бинарный файл с расписанием в память через mmap. Массивы времён в возвращаемом
+    словаре - срезы memoryview поверх отображённого файла, данные при этом не копируются.
+    Если MMAP_SCHEDULE выключен (Windows), файл читается в память, и срезы ссылаются на прочитанную копию
+    :param path: Путь к бинарному файлу
+    :return: Словарь с расписанием {станция: {тип дня: {направление: memoryview с временами}}}
+    """
+    with open(path, "rb") as file:
+        if MMAP_SCHEDULE:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buffer = file.read()
+
+    magic, version, header_length = _binary_prefix.unpack_from(buffer)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"Файл {path} не является расписанием версии {BINARY_VERSION}")
+
+    data_start = _binary_prefix.size + header_length
+    header = json.loads(buffer[_binary_prefix.size:data_start].decode("utf-8"))
+
+    data = memoryview(buffer)[data_start:]
+    if header["byteorder"] == sys.byteorder:
+        minutes = data.cast("H")
+    else:
+        swapped = array("H", data.tobytes())
+        swapped.byteswap()
+        minutes = memoryview(swapped)
+
+    schedule = {}
+    for station_name, day_type, direction, offset, length in header["index"]:
+        schedule.setdefault(station_name, {}).setdefault(day_type, {})[direction] = minutes[offset:offset + length]
+    return schedule
+
+
+def _read_schedule(path: str) -> dict:
+    """
+    Функция читает расписание из бинарного файла или из JSON в зависимости от пути
+    :param path: Путь к файлу с расписанием
+    :return: Словарь с расписанием
+    """
+    if path == SCHEDULE_BINARY_PATH:
+        return load_schedule_binary(path)
+
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _as_minutes(train_times):
+    """
+    Функция возвращает массив времён без копирования, если он уже компактный, иначе упаковывает его в array('H')
+    :param train_times: Массив времён
+    :return: memoryview или array('H')
+    """
+    if isinstance(train_times, (memoryview, array)):
+        return train_times
+    return array("H", train_times)
+
+
+def get_direction(start_station: str, finish_station: str) -> str:
+    """
+    Функция определяет направление движения поезда между двумя станциями
+    :param start_station: Название начальной станции
+    :param finish_station: Название конечной станции
+    :return: Направление (Ботаническая/Проспект Космонавтов)
+    """
+    if station_priority.get(start_station) < station_priority.get(finish_station):
+        return "Ботаническая"
+    return "Проспект Космонавтов"
+
+
+def build_trip_table(schedule: dict) -> dict:
+    """
+    Функция строит таблицу всех маршрутов между парами станций для каждого типа дня.
+    Для конечных станций сдвиг на 2 минуты от соседней станции уже учтён
+    :param schedule: Словарь с расписанием {станция: {тип дня: {направление: [времена]}}}
+    :return: Словарь {(тип дня, начальная станция, конечная станция): (отправления, прибытия)}
+    """
+    day_types = {day_type for station in schedule.values() for day_type in station}
+
+    trip_table = {}
+    for day_type in day_types:
+        for start_station in station_priority:
+            for finish_station in station_priority:
+                if start_station == finish_station:
+                    continue
+
+                direction = get_direction(start_station, finish_station)
+                arrival_station = terminal_neighbours.get(finish_station, finish_station)
+                offset = TERMINAL_TRAVEL_TIME if arrival_station != finish_station else 0
+
+                departures = schedule.get(start_station, {}).get(day_type, {}).get(direction)
+                arrivals = schedule.get(arrival_station, {}).get(day_type, {}).get(direction)
+                if not departures or not arrivals:
+                    continue
+
+                length = min(len(departures), len(arrivals))
+                if offset:
+                    arrivals = array("H", [time + offset for time in arrivals[:length]])
+                trip_table[(day_type, start_station, finish_station)] = (
+                    _as_minutes(departures[:length]),
+                    _as_minutes(arrivals[:length])
+                )
+
+    return trip_table
+
+
+def _load_snapshot(force: bool = False) -> tuple[dict, dict]:
+    """
+    Функция возвращает расписание и таблицу маршрутов из памяти процесса. Файл "ScheduleDB/schedule.bin"
+    (или "ScheduleDB/schedule.json", если бинарного файла нет) перечитывается только при первом обращении
+    и при изменении времени его последней модификации.
+    Новое расписание подменяется целиком, поэтому запросы никогда не видят частично загруженные данные
+    :param force: Перечитать файл, даже если он не изменялся
+    :return: Кортеж (расписание, таблица маршрутов)
+    """
+    global _snapshot, _schedule_source, _schedule_version
+
+    source = _get_source()
+    if not force and source == _schedule_source:
+        return _snapshot
+
+    with _schedule_lock:
+        # Пока ждали блокировку, расписание мог перечитать другой поток
+        source = _get_source()
+        if not force and source == _schedule_source:
+            return _snapshot
+
+        if source[0] is None:
+            raise FileNotFoundError(f"Не найден файл с расписанием {SCHEDULE_JSON_PATH}")
+        schedule = _read_schedule(source[0])
+
+        _snapshot, _schedule_source = (schedule, build_trip_table(schedule)), source
+        _schedule_version += 1
+        return _snapshot
+
+
+def load_schedule(force: bool = False) -> dict:
+    """
+    Функция возвращает расписание из памяти процесса, при необходимости перечитывая файл
+    :param force: Перечитать файл, даже если он не изменялся
+    :return: Словарь с расписанием {станция: {тип дня: {направление: массив времён}}}
+    """
+    return _load_snapshot(force)[0]
+
+
+def reload_schedule() -> dict:
+    """
+    Функция принудительно перечитывает расписание из файла
+    :return: Словарь с расписанием
+    """
+    return load_schedule(force=True)
+
+
+def get_schedule_version() -> int:
+    """
+    Функция возвращает номер текущей версии расписания в памяти. Номер увеличивается при каждой перезагрузке
+    :return: Номер версии расписания
+    """
+    _load_snapshot()
+    return _schedule_version
+
+
+def get_station_schedule(station_name: str, day_type: str, direction: str) -> list:
+    """
+    Функция возвращает расписание поездов для требуемых станции, типа дня и направления
+    :param station_name: Название начальной станции
+    :param day_type: Тип дня (Выходные/Рабочие)
+    :param direction: Направление (Ботаническая/Проспект космонавтов)
+    :return: Массив с расписанием поездов
+    """
+    return load_schedule().get(station_name, {}).get(day_type, {}).get(direction)
+
+
+def get_trip_table() -> dict:
+    """
+    Функция возвращает таблицу маршрутов текущей версии расписания
+    :return: Словарь {(тип дня, начальная станция, конечная станция): (отправления, прибытия)}
+    """
+    return _load_snapshot()[1]
+
+
+def get_trip(start_station: str, finish_station: str, day_type: str, trip_table: dict = None) -> tuple:
+    """
+    Функция возвращает выровненные массивы отправлений и прибытий для маршрута из таблицы маршрутов
+    :param start_station: Название начальной станции
+    :param finish_station: Название конечной станции
+    :param day_type: Тип дня (Выходные/Рабочие)
+    :param trip_table: Таблица маршрутов. Если не передана, используется текущая
+    :return: Кортеж (отправления, прибытия). Если для маршрута нет расписания, оба массива пустые
+    :raises KeyError: Если одна из станций неизвестна
+    """
+    if start_station not in station_priority or finish_station not in station_priority:
+        raise KeyError(f"Неизвестный маршрут {start_station}->{finish_station}")
+
+    if trip_table is None:
+        trip_table = get_trip_table()
+    return trip_table.get((day_type, start_station, finish_station), ((), ()))
+
+
+def to_schedule_time(time: int, schedule) -> int:
+    """
+    Функция приводит время к формату расписания, в котором поезда после полуночи идут как 24 * 60 + минуты.
+    Время сдвигается на сутки, только если после полуночи по этому расписанию ещё ходят поезда
+    :param time: Время в формате (Часы * 60 + Минуты)
+    :param schedule: Отсортированный массив с расписанием поездов
+    :return: Время в формате расписания
+    """
+    if schedule and time < schedule[0] and time + MINUTES_IN_DAY <= schedule[-1]:
+        return time + MINUTES_IN_DAY
+    return time
+
+
+def get_next_departures(start_station: str, finish_station: str, day_type: str, time: int,
+                        count: int, trip_table: dict = None) -> tuple:
+    """
+    Функция находит бинарным поиском ближайшие поезда, отправляющиеся не раньше переданного времени
+    :param start_station: Название начальной станции
+    :param finish_station: Название конечной станции
+    :param day_type: Тип дня (Выходные/Рабочие)
+    :param time: Время в формате (Часы * 60 + Минуты)
+    :param count: Требуемое количество поездов
+    :param trip_table: Таблица маршрутов. Если не передана, используется текущая
+    :return: Выровненные друг с другом срезы времён отправления и прибытия
+    """
+    departures, arrivals = get_trip(start_station, finish_station, day_type, trip_table)
+
+    first = bisect_left(departures, to_schedule_time(time, departures))
+    return departures[first:first + count], arrivals[first:first + count]
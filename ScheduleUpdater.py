@@ -0,0 +1,148 @@
+from os import sep, stat
+import threading
+import logging
+import time
+
+from Config import get_settings
+from ScheduleParser import (update_all_links, download_schedule_pages, update_schedule_json, load_pages_meta,
+                            save_pages_meta)
+
+logger = logging.getLogger(__name__)
+
+STATION_LINKS_PATH = f"ScheduleDB{sep}AllPages{sep}station_links.json"
+# Файл-отметка последнего успешного обновления расписания: пишется, только когда все страницы скачаны
+# и расписание пересобрано, поэтому после сбоя обновление повторяется при следующей проверке
+SCHEDULE_REFRESH_MARKER_PATH = f"ScheduleDB{sep}AllPages{sep}last_schedule_refresh"
+
+# Периодичность обновлений в секундах: ссылки на страницы станций, сами страницы с расписанием
+# и интервал, с которым фоновый поток проверяет, не пора ли что-то обновить.
+# В боте значения задаются настройками links_refresh_interval, pages_refresh_interval и refresh_check_interval
+LINKS_REFRESH_INTERVAL = 30 * 24 * 60 * 60
+PAGES_REFRESH_INTERVAL = 7 * 24 * 60 * 60
+CHECK_INTERVAL = 60 * 60
+
+_updater_thread = None
+_stop_event = threading.Event()
+
+
+def _get_last_refresh(path: str) -> float:
+    """
+    Функция возвращает время последнего обновления по времени изменения файла, который это обновление пишет.
+    Так после перезапуска бота обновление не запускается раньше срока
+    :param path: Путь к файлу
+    :return: UTC timestamp последнего изменения или 0, если файла нет
+    """
+    try:
+        return stat(path).st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def _mark_refresh(path: str):
+    """
+    Функция отмечает успешное обновление, записывая в файл-отметку текущее время
+    :param path: Путь к файлу-отметке
+    """
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(str(time.time()))
+
+
+def refresh_links():
+    """
+    Функция обновляет ссылки на страницы станций
+    """
+    update_all_links()
+
+
+def refresh_schedule() -> list[str]:
+    """
+    Функция скачивает страницы станций и пересобирает расписание только для изменившихся станций.
+    Новое расписание подменяется в памяти бота целиком. Заголовки и хэши страниц сохраняются только
+    после пересборки, а отметка об успешном обновлении - только если скачались все страницы
+    :return: Отчёт об изменившихся массивах расписания
+    :raises RuntimeError: Если часть страниц не удалось скачать
+    """
+    changed_stations, pages_meta, failed_stations = download_schedule_pages()
+
+    report = []
+    if changed_stations:
+        try:
+            report = update_schedule_json(changed_stations, workers=get_settings().parse_workers)
+        except Exception:
+            # Новые страницы уже сохранены: хэши изменившихся станций сбрасываются,
+            # чтобы следующее обновление пересобрало их, даже если страницы больше не изменятся
+            save_pages_meta({**load_pages_meta(), **{name: {"sha256": ""} for name in changed_stations}})
+            raise
+    save_pages_meta(pages_meta)
+
+    if failed_stations:
+        raise RuntimeError(f"Не удалось скачать страницы станций: {', '.join(failed_stations)}")
+
+    _mark_refresh(SCHEDULE_REFRESH_MARKER_PATH)
+    return report
+
+
+def run_due_refreshes(links_interval: float = LINKS_REFRESH_INTERVAL, pages_interval: float = PAGES_REFRESH_INTERVAL):
+    """
+    Функция выполняет обновления, срок которых подошёл. Ошибка одного обновления не мешает остальным
+    :param links_interval: Периодичность обновления ссылок в секундах
+    :param pages_interval: Периодичность обновления страниц и расписания в секундах
+    """
+    current_time = time.time()
+
+    if current_time - _get_last_refresh(STATION_LINKS_PATH) >= links_interval:
+        try:
+            refresh_links()
+        except Exception:
+            logger.exception("Не удалось обновить ссылки на страницы станций")
+
+    if current_time - _get_last_refresh(SCHEDULE_REFRESH_MARKER_PATH) >= pages_interval:
+        try:
+            refresh_schedule()
+        except Exception:
+            logger.exception("Не удалось обновить расписание")
+
+
+def _updater_loop(links_interval: float, pages_interval: float, check_interval: float):
+    """
+    Цикл фонового потока: проверяет сроки обновлений, пока поток не остановят
+    :param links_interval: Периодичность обновления ссылок в секундах
+    :param pages_interval: Периодичность обновления страниц и расписания в секундах
+    :param check_interval: Интервал между проверками в секундах
+    """
+    while not _stop_event.is_set():
+        run_due_refreshes(links_interval, pages_interval)
+        _stop_event.wait(check_interval)
+
+
+def start_schedule_updater(links_interval: float = LINKS_REFRESH_INTERVAL,
+                           pages_interval: float = PAGES_REFRESH_INTERVAL,
+                           check_interval: float = CHECK_INTERVAL) -> threading.Thread:
+    """
+    Функция запускает фоновый поток обновления расписания. Запуск не ждёт ни одного обновления,
+    поэтому бот сразу начинает отвечать пользователям по уже загруженному расписанию
+    :param links_interval: Периодичность обновления ссылок в секундах
+    :param pages_interval: Периодичность обновления страниц и расписания в секундах
+    :param check_interval: Интервал между проверками в секундах
+    :return: Объект запущенного потока
+    """
+    global _updater_thread
+
+    if _updater_thread is not None and _updater_thread.is_alive():
+        return _updater_thread
+
+    _stop_event.clear()
+    _updater_thread = threading.Thread(target=_updater_loop, args=(links_interval, pages_interval, check_interval),
+                                       name="ScheduleUpdater", daemon=True)
+    _updater_thread.start()
+    return _updater_thread
+
+
+def stop_schedule_updater(timeout: float = None):
+    """
+    Функция останавливает фоновый поток обновления расписания
+    :param timeout: Максимальное время ожидания завершения потока в секундах
+    """
+    _stop_event.set()
+    if _updater_thread is not None:
+        _updater_thread.join(timeout)
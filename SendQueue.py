@@ -0,0 +1,287 @@
+from collections import OrderedDict, deque
+import threading
+import logging
+import atexit
+import time
+
+import requests
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+# Ограничения Telegram: около 30 сообщений в секунду на бота и около 1 сообщения в секунду в один чат.
+# Чату разрешён короткий всплеск, чтобы "🤔" и готовое расписание не ждали друг друга
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+CHAT_BUCKETS_SIZE = 10000
+
+SEND_WORKERS = 4
+# Сколько раз повторяется запрос, упавший не из-за ограничения частоты, и пауза перед повтором в секундах
+SEND_RETRIES = 3
+RETRY_DELAY = 1.0
+# Отправка нового сообщения повторяется, только если запрос точно не дошёл до Telegram. После таймаута чтения
+# сообщение могло быть доставлено, и повтор создал бы дубль, сбивающий адресацию по message_id + 1
+SEND_MESSAGE_RETRY_ERRORS = (requests.ConnectionError, requests.ConnectTimeout)
+
+_queue_condition = threading.Condition()
+# Очереди сообщений чатов: {chat_id: deque с запросами}. Запросы одного чата отправляются строго по порядку
+_chat_queues: dict = {}
+# Чаты с неотправленными запросами, которые сейчас никто не отправляет, в порядке обхода
+_ready_chats: deque = deque()
+_in_flight_chats: set = set()
+# Ещё не отправленные изменения сообщений: {(chat_id, message_id): запрос}
+_pending_edits: dict = {}
+# Корзины токенов: [доступные токены, время последнего пополнения]
+_global_bucket = [float(GLOBAL_BURST), time.monotonic()]
+_chat_buckets: OrderedDict = OrderedDict()
+# Чаты, которым Telegram велел подождать: {chat_id: момент, до которого отправлять нельзя}
+_chat_paused_until: dict = {}
+
+_workers: list = []
+_stats = {"sent": 0, "coalesced": 0, "rate_limited": 0, "retried": 0, "failed": 0}
+
+
+def _refill_bucket(bucket: list, rate: float, capacity: int, current_time: float) -> float:
+    """
+    Функция пополняет корзину токенов за прошедшее время
+    :param bucket: Корзина [доступные токены, время последнего пополнения]
+    :param rate: Скорость пополнения в токенах в секунду
+    :param capacity: Вместимость корзины
+    :param current_time: Текущее время time.monotonic()
+    :return: Сколько секунд ждать до появления токена, 0 - токен есть
+    """
+    bucket[0] = min(capacity, bucket[0] + (current_time - bucket[1]) * rate)
+    bucket[1] = current_time
+    return 0 if bucket[0] >= 1 else (1 - bucket[0]) / rate
+
+
+def _get_chat_bucket(chat_id: int) -> list:
+    """
+    Функция возвращает корзину токенов чата, вытесняя корзины давно не писавших чатов
+    :param chat_id: ID чата
+    :return: Корзина [доступные токены, время последнего пополнения]
+    """
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = [float(CHAT_BURST), time.monotonic()]
+        if len(_chat_buckets) > CHAT_BUCKETS_SIZE:
+            _chat_buckets.popitem(last=False)
+    else:
+        _chat_buckets.move_to_end(chat_id)
+    return bucket
+
+
+def _take_next_request():
+    """
+    Функция выбирает следующий запрос, который можно отправить, не нарушая ограничений.
+    Вызывается под _queue_condition
+    :return: Кортеж (запрос, 0) или (None, время ожидания в секундах). Время None - ждать нового запроса
+    """
+    current_time = time.monotonic()
+    global_wait = _refill_bucket(_global_bucket, GLOBAL_RATE, GLOBAL_BURST, current_time)
+    if _ready_chats and global_wait:
+        return None, global_wait
+
+    min_wait = None
+    for _ in range(len(_ready_chats)):
+        chat_id = _ready_chats.popleft()
+        wait = max(_chat_paused_until.get(chat_id, 0) - current_time,
+                   _refill_bucket(_get_chat_bucket(chat_id), CHAT_RATE, CHAT_BURST, current_time))
+        if wait > 0:
+            _ready_chats.append(chat_id)
+            min_wait = wait if min_wait is None else min(min_wait, wait)
+            continue
+
+        _chat_paused_until.pop(chat_id, None)
+        request = _chat_queues[chat_id].popleft()
+        if request["key"] is not None and _pending_edits.get(request["key"]) is request:
+            del _pending_edits[request["key"]]
+
+        _global_bucket[0] -= 1
+        _chat_buckets[chat_id][0] -= 1
+        _in_flight_chats.add(chat_id)
+        return request, 0
+
+    return None, min_wait
+
+
+def _finish_request(request: dict, outcome: str, retry_after: float = None):
+    """
+    Функция освобождает чат после попытки отправки. Если запрос нужно повторить, он возвращается в начало
+    очереди чата, а чат ставится на паузу. Повтор изменения сообщения не нужен, если в очереди уже есть более новое
+    :param request: Запрос
+    :param outcome: Итог попытки - ключ счётчика в статистике
+    :param retry_after: Через сколько секунд повторить запрос. None - запрос завершён
+    """
+    chat_id = request["chat_id"]
+    with _queue_condition:
+        _stats[outcome] += 1
+        _in_flight_chats.discard(chat_id)
+        chat_queue = _chat_queues[chat_id]
+
+        if retry_after is not None:
+            _chat_paused_until[chat_id] = time.monotonic() + retry_after
+            if request["key"] is None:
+                chat_queue.appendleft(request)
+            elif request["key"] not in _pending_edits:
+                _pending_edits[request["key"]] = request
+                chat_queue.appendleft(request)
+
+        if chat_queue:
+            _ready_chats.append(chat_id)
+        else:
+            del _chat_queues[chat_id]
+        _queue_condition.notify_all()
+
+
+def _send(request: dict):
+    """
+    Функция отправляет запрос в Telegram. При ответе 429 чат ставится на паузу на указанное Telegram время,
+    при других сбоях запрос повторяется до SEND_RETRIES раз. Отправка нового сообщения повторяется только
+    при ошибках соединения (SEND_MESSAGE_RETRY_ERRORS)
+    :param request: Запрос
+    """
+    try:
+        getattr(request["bot"], request["method"])(*request["args"], **request["kwargs"])
+    except ApiTelegramException as error:
+        if error.error_code == 429:
+            retry_after = (error.result_json.get("parameters") or {}).get("retry_after", RETRY_DELAY)
+            logger.warning("Telegram ограничил частоту отправки в чат %s на %s с", request["chat_id"], retry_after)
+            _finish_request(request, "rate_limited", retry_after)
+            return
+
+        # Например, "message is not modified" - повторять такой запрос бессмысленно
+        logger.warning("Telegram отклонил %s в чат %s: %s", request["method"], request["chat_id"], error.description)
+        _finish_request(request, "failed")
+    except Exception as error:
+        request["attempts"] += 1
+        is_retryable = request["method"] != "send_message" or isinstance(error, SEND_MESSAGE_RETRY_ERRORS)
+        if is_retryable and request["attempts"] < SEND_RETRIES:
+            _finish_request(request, "retried", RETRY_DELAY * request["attempts"])
+            return
+
+        logger.exception("Не удалось выполнить %s в чат %s", request["method"], request["chat_id"])
+        _finish_request(request, "failed")
+    else:
+        _finish_request(request, "sent")
+
+
+def _worker_loop():
+    """
+    Цикл потока отправки: берёт доступные по ограничениям запросы и отправляет их
+    """
+    while True:
+        with _queue_condition:
+            request, wait = _take_next_request()
+            while request is None:
+                _queue_condition.wait(wait)
+                request, wait = _take_next_request()
+
+        _send(request)
+
+
+def _start_workers():
+    """
+    Функция запускает потоки отправки при первом запросе. Вызывается под _queue_condition
+    """
+    if _workers:
+        return
+
+    for number in range(SEND_WORKERS):
+        worker = threading.Thread(target=_worker_loop, name=f"SendQueue-{number}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+    atexit.register(flush_send_queue, 10)
+
+
+def _enqueue(bot: telebot.TeleBot, method: str, chat_id: int, args: tuple, kwargs: dict, message_id: int = None):
+    """
+    Функция ставит запрос в очередь чата. Изменение сообщения, которое ещё ждёт отправки предыдущего
+    изменения того же сообщения, не добавляется в очередь, а заменяет его: уйдёт только последний текст
+    :param bot: Бот, от имени которого выполняется запрос
+    :param method: Название метода бота
+    :param chat_id: ID чата
+    :param args: Позиционные аргументы метода
+    :param kwargs: Именованные аргументы метода
+    :param message_id: ID изменяемого сообщения для объединения изменений
+    """
+    key = (chat_id, message_id) if message_id is not None else None
+
+    with _queue_condition:
+        _start_workers()
+
+        pending_edit = _pending_edits.get(key) if key is not None else None
+        if pending_edit is not None and pending_edit["bot"] is bot:
+            pending_edit["args"], pending_edit["kwargs"] = args, kwargs
+            _stats["coalesced"] += 1
+            return
+
+        request = {"bot": bot, "method": method, "chat_id": chat_id, "args": args, "kwargs": kwargs,
+                   "key": key, "attempts": 0}
+        if key is not None:
+            _pending_edits[key] = request
+
+        chat_queue = _chat_queues.get(chat_id)
+        if chat_queue is None:
+            chat_queue = _chat_queues[chat_id] = deque()
+            if chat_id not in _in_flight_chats:
+                _ready_chats.append(chat_id)
+        chat_queue.append(request)
+        _queue_condition.notify()
+
+
+def queue_send_message(bot: telebot.TeleBot, chat_id: int, text: str, **kwargs):
+    """
+    Функция ставит отправку сообщения в очередь
+    :param bot: Бот, от имени которого отправляется сообщение
+    :param chat_id: ID чата
+    :param text: Текст сообщения
+    :param kwargs: Именованные аргументы TeleBot.send_message
+    """
+    _enqueue(bot, "send_message", chat_id, (chat_id, text), kwargs)
+
+
+def queue_edit_message_text(bot: telebot.TeleBot, text: str, chat_id: int, message_id: int, **kwargs):
+    """
+    Функция ставит изменение текста сообщения в очередь. Неотправленное прошлое изменение того же сообщения
+    заменяется новым
+    :param bot: Бот, от имени которого изменяется сообщение
+    :param text: Новый текст сообщения
+    :param chat_id: ID чата
+    :param message_id: ID сообщения
+    :param kwargs: Именованные аргументы TeleBot.edit_message_text
+    """
+    _enqueue(bot, "edit_message_text", chat_id, (text, chat_id, message_id), kwargs, message_id)
+
+
+def queue_delete_message(bot: telebot.TeleBot, chat_id: int, message_id: int):
+    """
+    Функция ставит удаление сообщения в очередь
+    :param bot: Бот, от имени которого удаляется сообщение
+    :param chat_id: ID чата
+    :param message_id: ID сообщения
+    """
+    _enqueue(bot, "delete_message", chat_id, (chat_id, message_id), {})
+
+
+def flush_send_queue(timeout: float = None) -> bool:
+    """
+    Функция ждёт, пока все запросы из очереди будут отправлены
+    :param timeout: Максимальное время ожидания в секундах
+    :return: True, если очередь пуста
+    """
+    with _queue_condition:
+        return _queue_condition.wait_for(lambda: not _chat_queues, timeout)
+
+
+def get_send_queue_stats() -> dict:
+    """
+    Функция возвращает статистику очереди отправки
+    :return: Словарь со счётчиками отправленных, объединённых, ограниченных Telegram, повторённых
+    и неудавшихся запросов и количеством запросов в очереди
+    """
+    with _queue_condition:
+        return {**_stats, "queued": sum(len(chat_queue) for chat_queue in _chat_queues.values())}
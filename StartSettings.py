@@ -1,10 +1,25 @@
-from UsersDataBase import create_table, add_user, add_favorite_trip
+from UsersDataBase import create_table, get_legacy_bot_tokens, delete_legacy_bot_tokens
+from Config import update_settings, load_file_settings, is_token_set
 
 YOUR_MAIN_BOT_TOKEN = "ваш_токен_основного_бота"
 YOUR_FEEDBACK_BOT_TOKEN = "ваш_токен_бота_для_обратной_связи"
 
 if __name__ == '__main__':
     create_table()
-    add_user(1, "TOKENS", None, None, None)
-    add_favorite_trip(1, YOUR_MAIN_BOT_TOKEN)
-    add_favorite_trip(1, YOUR_FEEDBACK_BOT_TOKEN)
+
+    # Токены, которые старые версии бота хранили в базе пользователей, переносятся в config.json
+    legacy_tokens = get_legacy_bot_tokens()
+    new_tokens = legacy_tokens or [YOUR_MAIN_BOT_TOKEN, YOUR_FEEDBACK_BOT_TOKEN]
+
+    # Уже заданные в config.json токены не перезаписываются
+    file_settings = load_file_settings()
+    changes = {name: token
+               for name, current_token, token in zip(("main_bot_token", "feedback_bot_token"),
+                                                     (file_settings.main_bot_token, file_settings.feedback_bot_token),
+                                                     new_tokens)
+               if not is_token_set(current_token)}
+    update_settings(**changes)
+
+    # Служебная строка с токенами удаляется, только когда config.json уже записан
+    if legacy_tokens:
+        delete_legacy_bot_tokens()
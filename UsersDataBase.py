@@ -1,92 +1,297 @@
 import json
 from os import sep
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
 import datetime
 import sqlite3
+import logging
+import atexit
+import time
 from typing import Any
 
+from Config import get_settings
+
 sqlite3.register_adapter(datetime.date, lambda val: val.isoformat())
 
+logger = logging.getLogger(__name__)
+
+DB_PATH = f"UsersDB{sep}users.db"
+
+# Настройки соединения: WAL позволяет читателям не ждать писателей, synchronous=NORMAL в режиме WAL
+# не теряет целостность базы, cache_size задан в КиБ (отрицательное значение), mmap_size - в байтах
+DB_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -8000,
+    "mmap_size": 64 * 1024 * 1024,
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY"
+}
+# Размер кэша подготовленных выражений в каждом соединении
+DB_CACHED_STATEMENTS = 128
+
+_local = threading.local()
+
+# Кэш строк пользователей: {chat_id: (момент устаревания, строка)}. Устаревшие и самые старые записи вытесняются
+SESSION_TTL = 15 * 60
+SESSION_CACHE_SIZE = get_settings().session_cache_size
+# Состояние навигации по меню (столбцы 5 и 7) пишется в базу отложенно и пачками,
+# остальные столбцы, например count_trains, записываются сразу
+TRANSIENT_COLUMNS = {5, 7}
+WRITE_BEHIND_DELAY = 2.0
+WRITE_BEHIND_BATCH_SIZE = 500
+
+column_mapping = {
+    0: "chat_id",
+    1: "username",
+    2: "first_name",
+    3: "last_name",
+    4: "register_date",
+    5: "last_selected_start_station",
+    6: "count_trains",
+    7: "selected_trip_to_remove"
+}
+
+_sessions: OrderedDict = OrderedDict()
+# Ещё не записанные в базу изменения: {chat_id: {столбец: значение}} и изменения, которые записываются прямо сейчас
+_pending_writes: dict = {}
+_in_flight_writes: dict = {}
+# Пользователи, ожидающие добавления в базу: {chat_id: (chat_id, username, first_name, last_name, register_date)}
+_pending_users: dict = {}
+_in_flight_users: dict = {}
+# Запись очереди и чтение строки пользователя с наложением неотправленных изменений не должны перемежаться,
+# иначе в кэш сессий попадёт строка без только что записанных изменений. Блокировка повторно входимая,
+# потому что чтение само может записать очередь (_flush_pending_user)
+_flush_lock = threading.RLock()
+_session_lock = threading.RLock()
+_flush_event = threading.Event()
+_flush_thread = None
+
 
 def get_db_connection():
     """
-    Создает новое соединение с базой данных и возвращает его.
+    Возвращает постоянное соединение с базой данных для текущего потока, создавая его при первом обращении.
+    Подготовленные выражения кэшируются соединением, поэтому повторные запросы не компилируются заново.
     """
-    conn = sqlite3.connect(f"UsersDB{sep}users.db")
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_local, "connection", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        for pragma, value in DB_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        _local.connection = conn
     return conn
 
 
+@contextmanager
+def transaction():
+    """
+    Контекстный менеджер транзакции на соединении текущего потока. Фиксирует изменения при выходе из блока
+    и откатывает их при ошибке. Внутри write_batch изменения фиксируются только в конце пакета
+    """
+    conn = get_db_connection()
+    if getattr(_local, "batch_depth", 0):
+        yield conn
+        return
+
+    with conn:
+        yield conn
+
+
+@contextmanager
+def write_batch():
+    """
+    Контекстный менеджер, объединяющий все записи в базу данных внутри блока в одну транзакцию
+    """
+    conn = get_db_connection()
+    _local.batch_depth = getattr(_local, "batch_depth", 0) + 1
+    try:
+        if _local.batch_depth > 1:
+            yield conn
+        else:
+            with conn:
+                yield conn
+    finally:
+        _local.batch_depth -= 1
+
+
+def close_db_connection():
+    """
+    Закрывает соединение с базой данных текущего потока, если оно было открыто.
+    """
+    conn = getattr(_local, "connection", None)
+    if conn is not None:
+        conn.close()
+        _local.connection = None
+
+
 def create_table():
     """
     Функция создаёт базу данных, если она не была создана ранее
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Users (
-            chat_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            register_date DATE,
-            last_selected_start_station TEXT,
-            count_trains INTEGER,
-            favorite_trips TEXT,
-            selected_trip_to_remove TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS Users (
+                chat_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                register_date DATE,
+                last_selected_start_station TEXT,
+                count_trains INTEGER,
+                favorite_trips TEXT,
+                selected_trip_to_remove TEXT
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS FavoriteTrips (
+                chat_id INTEGER NOT NULL,
+                start TEXT NOT NULL,
+                finish TEXT NOT NULL,
+                position INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS FavoriteTrips_route "
+                     "ON FavoriteTrips (chat_id, start, finish)")
+        conn.execute("CREATE INDEX IF NOT EXISTS FavoriteTrips_position ON FavoriteTrips (chat_id, position)")
+
+    migrate_favorite_trips()
+
+
+def migrate_favorite_trips():
+    """
+    Функция переносит избранные маршруты из JSON в столбце Users.favorite_trips в таблицу FavoriteTrips.
+    Строки, в которых есть значения не вида "станция->станция" (например, токены ботов), не переносятся.
+    Также удаляются маршруты без начальной станции, которые сохраняли прошлые версии бота
+    """
+    with transaction() as conn:
+        rows = conn.execute("SELECT chat_id, favorite_trips FROM Users WHERE favorite_trips IS NOT NULL").fetchall()
+        for chat_id, trips_json in rows:
+            favorite_trips = json.loads(trips_json) if trips_json else []
+            routes = [trip.split("->") for trip in favorite_trips if trip.count("->") == 1]
+            if len(routes) != len(favorite_trips):
+                continue
+
+            conn.executemany("INSERT OR IGNORE INTO FavoriteTrips (chat_id, start, finish, position) "
+                             "VALUES (?, ?, ?, ?)",
+                             [(chat_id, start, finish, position) for position, (start, finish) in enumerate(routes)])
+            conn.execute("UPDATE Users SET favorite_trips = NULL WHERE chat_id = ?", (chat_id,))
+
+        conn.execute("DELETE FROM FavoriteTrips WHERE start = 'None' OR finish = 'None'")
 
 
 def get_all_users() -> list[Any]:
     """
     Функция возвращает список пользователей, хранящихся в базе данных
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM Users")
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    return get_db_connection().execute("SELECT * FROM Users").fetchall()
+
+
+def _cache_user(chat_id: int, user: dict):
+    """
+    Функция кладёт строку пользователя в кэш сессий, вытесняя самую старую запись при переполнении
+    :param chat_id: ID пользователя
+    :param user: Словарь с данными пользователя
+    """
+    with _session_lock:
+        _sessions[chat_id] = (time.monotonic() + SESSION_TTL, user)
+        _sessions.move_to_end(chat_id)
+        if len(_sessions) > SESSION_CACHE_SIZE:
+            _sessions.popitem(last=False)
+
+
+def invalidate_user_cache(chat_id: int):
+    """
+    Функция удаляет пользователя из кэша сессий. Следующее чтение пойдёт в базу данных
+    :param chat_id: ID пользователя
+    """
+    with _session_lock:
+        _sessions.pop(chat_id, None)
 
 
 def get_current_user(chat_id: int) -> dict:
     """
     Функция возвращает данные одного пользователя по его chat_id в виде словаря.
+    Данные берутся из кэша сессий, а при его отсутствии или устаревании - из базы данных
+    с учётом ещё не записанных изменений. Чтение из базы идёт под _flush_lock, чтобы запись очереди
+    не произошла между чтением строки и наложением изменений
     :param chat_id: ID пользователя
     :return: Словарь с данными пользователя
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if row is not None:
-        return dict(row)
-    else:
-        return {}
+    with _session_lock:
+        entry = _sessions.get(chat_id)
+        if entry is not None:
+            expires_at, user = entry
+            if expires_at > time.monotonic():
+                _sessions.move_to_end(chat_id)
+                return dict(user)
+            del _sessions[chat_id]
+
+    with _flush_lock:
+        _flush_pending_user(chat_id)
+        row = get_db_connection().execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return {}
+
+        user = dict(row)
+        with _session_lock:
+            user.update(_in_flight_writes.get(chat_id, {}))
+            user.update(_pending_writes.get(chat_id, {}))
+        _cache_user(chat_id, user)
+    return dict(user)
 
 
 def add_user(chat_id: int, username: str, first_name: str, last_name: str, register_date: datetime.date):
     """
-    Функция добавляет нового пользователя в базу данных, при условии,
-    что пользователя с таким chat_id нет в базе данных.
+    Функция добавляет нового пользователя в базу данных одним запросом. Если пользователь с таким chat_id
+    уже есть, у него обновляются только имя аккаунта, имя и фамилия, а настройки и дата регистрации сохраняются.
     :param chat_id: ID Чата в Телеграмм
     :param username: Имя аккаунта Телеграмм без "@"
     :param first_name: Имя пользователя
     :param last_name: Фамилия пользователя
     :param register_date: Дата регистрации
     """
-    if not get_current_user(chat_id):
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO Users (chat_id, username, first_name, last_name, register_date, "
-                       "last_selected_start_station, count_trains, favorite_trips, selected_trip_to_remove) "
-                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                       (chat_id, username, first_name, last_name, register_date, None, 3, None, None))
-        conn.commit()
-        conn.close()
+    add_users([(chat_id, username, first_name, last_name, register_date)])
+
+
+def add_users(users: list):
+    """
+    Функция добавляет или обновляет сразу нескольких пользователей одной транзакцией (см. add_user)
+    :param users: Массив кортежей (chat_id, username, first_name, last_name, register_date)
+    """
+    if not users:
+        return
+
+    with transaction() as conn:
+        conn.executemany("INSERT INTO Users (chat_id, username, first_name, last_name, register_date, "
+                         "last_selected_start_station, count_trains, favorite_trips, selected_trip_to_remove) "
+                         "VALUES (?, ?, ?, ?, ?, NULL, 3, NULL, NULL) "
+                         "ON CONFLICT (chat_id) DO UPDATE SET username = excluded.username, "
+                         "first_name = excluded.first_name, last_name = excluded.last_name",
+                         users)
+
+    with _session_lock:
+        for user in users:
+            _sessions.pop(user[0], None)
+
+
+def enqueue_add_user(chat_id: int, username: str, first_name: str, last_name: str, register_date: datetime.date):
+    """
+    Функция ставит добавление пользователя в очередь отложенной записи. Очередь записывается в базу данных
+    одной транзакцией вместе с остальными отложенными изменениями по времени или при накоплении пачки
+    :param chat_id: ID Чата в Телеграмм
+    :param username: Имя аккаунта Телеграмм без "@"
+    :param first_name: Имя пользователя
+    :param last_name: Фамилия пользователя
+    :param register_date: Дата регистрации
+    """
+    with _session_lock:
+        _pending_users[chat_id] = (chat_id, username, first_name, last_name, register_date)
+        _sessions.pop(chat_id, None)
+        _start_flush_thread()
+        if len(_pending_users) + len(_pending_writes) >= WRITE_BEHIND_BATCH_SIZE:
+            _flush_event.set()
 
 
 def delete_user(chat_id):
@@ -94,16 +299,21 @@ def delete_user(chat_id):
     Функция удаляет пользователя из базы данных по его user_id.
     :param chat_id: ID пользователя
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
-    conn.commit()
-    conn.close()
+    with _session_lock:
+        _sessions.pop(chat_id, None)
+        _pending_writes.pop(chat_id, None)
+        _pending_users.pop(chat_id, None)
+
+    with transaction() as conn:
+        conn.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
 
 
 def update_user_data(chat_id: int, column_numbers: list, new_values: list):
     """
     Функция изменяет данные в требуемых столбцах на необходимые для конкретного пользователя.
+    Состояние навигации по меню (столбцы 5 и 7) сразу меняется в кэше сессий, а в базу данных
+    записывается отложенно пачкой вместе с изменениями других пользователей.
+    Остальные столбцы записываются в базу данных сразу.
 
     Столбцы имеют следующие номера
         0. **chat_id:** ID Чата в Телеграмм
@@ -126,74 +336,160 @@ def update_user_data(chat_id: int, column_numbers: list, new_values: list):
     :param column_numbers: Массив с номерами столбцов, которые нужно изменить.
     :param new_values: Массив с новыми значениями для соответствующих столбцов
     """
-    column_mapping = {
-        0: "chat_id",
-        1: "username",
-        2: "first_name",
-        3: "last_name",
-        4: "register_date",
-        5: "last_selected_start_station",
-        6: "count_trains",
-        7: "selected_trip_to_remove"
-    }
+    changes = {column_mapping[num]: value for num, value in zip(column_numbers, new_values)}
 
-    columns = [column_mapping[num] for num in column_numbers]
+    with _session_lock:
+        entry = _sessions.get(chat_id)
+        if entry is not None:
+            entry[1].update(changes)
 
-    set_clause = ", ".join([f"{column} = ?" for column in columns])
+        if set(column_numbers) <= TRANSIENT_COLUMNS:
+            _pending_writes.setdefault(chat_id, {}).update(changes)
+            _start_flush_thread()
+            if len(_pending_writes) >= WRITE_BEHIND_BATCH_SIZE:
+                _flush_event.set()
+            return
 
-    values = tuple(new_values)
+    _flush_pending_user(chat_id)
+    set_clause = ", ".join([f"{column} = ?" for column in changes])
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(f"UPDATE users SET {set_clause} WHERE chat_id = ?", (*values, chat_id))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(f"UPDATE users SET {set_clause} WHERE chat_id = ?", (*changes.values(), chat_id))
 
 
-def add_favorite_trip(chat_id, new_trip):
+def flush_pending_writes():
+    """
+    Функция записывает в базу данных всех ожидающих пользователей и все отложенные изменения одной транзакцией.
+    Если запись не удалась, изменения возвращаются в очередь и будут записаны при следующей попытке
+    """
+    global _pending_writes, _in_flight_writes, _pending_users, _in_flight_users
+
+    with _flush_lock:
+        with _session_lock:
+            if not _pending_writes and not _pending_users:
+                return
+            pending = _in_flight_writes = _pending_writes
+            users = _in_flight_users = _pending_users
+            _pending_writes, _pending_users = {}, {}
+
+        try:
+            with write_batch() as conn:
+                add_users(list(users.values()))
+                for chat_id, changes in pending.items():
+                    set_clause = ", ".join([f"{column} = ?" for column in changes])
+                    conn.execute(f"UPDATE users SET {set_clause} WHERE chat_id = ?", (*changes.values(), chat_id))
+        except sqlite3.Error:
+            with _session_lock:
+                _pending_users = {**users, **_pending_users}
+                for chat_id, changes in pending.items():
+                    _pending_writes[chat_id] = {**changes, **_pending_writes.get(chat_id, {})}
+            raise
+        finally:
+            with _session_lock:
+                _in_flight_writes, _in_flight_users = {}, {}
+
+
+def _flush_pending_user(chat_id: int):
     """
-    Функция добавляет новый избранный маршрут для пользователя
+    Функция записывает очередь отложенных изменений, если пользователь ещё ждёт добавления в базу данных,
+    чтобы последующие запросы к его строке не прошли мимо неё
     :param chat_id: ID пользователя
-    :param new_trip: Новый избранный маршрут
     """
-    favorite_trips = get_favorite_trips(chat_id)
-    favorite_trips.append(new_trip)
-    trips_json = json.dumps(favorite_trips)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE Users SET favorite_trips = ? WHERE chat_id = ?", (trips_json, chat_id))
-    conn.commit()
-    conn.close()
+    with _session_lock:
+        is_pending = chat_id in _pending_users or chat_id in _in_flight_users
+    if is_pending:
+        flush_pending_writes()
+
+
+def _flush_loop():
+    """
+    Цикл фонового потока, записывающего отложенные изменения в базу данных
+    """
+    while True:
+        _flush_event.wait(WRITE_BEHIND_DELAY)
+        _flush_event.clear()
+        try:
+            flush_pending_writes()
+        except sqlite3.Error:
+            logger.exception("Не удалось записать отложенные изменения пользователей")
+
+
+def _start_flush_thread():
+    """
+    Функция запускает фоновый поток отложенной записи, если он ещё не запущен
+    """
+    global _flush_thread
+
+    if _flush_thread is None:
+        _flush_thread = threading.Thread(target=_flush_loop, name="UsersDataBaseFlush", daemon=True)
+        _flush_thread.start()
+        atexit.register(flush_pending_writes)
+
+
+def add_favorite_trip(chat_id, new_trip) -> bool:
+    """
+    Функция добавляет новый избранный маршрут в конец списка избранных маршрутов пользователя.
+    Повторное добавление того же маршрута ничего не меняет
+    :param chat_id: ID пользователя
+    :param new_trip: Новый избранный маршрут в формате "станция->станция"
+    :return: True, если маршрут добавлен, и False, если он уже был в избранном
+    """
+    start, finish = new_trip.split("->")
+    with transaction() as conn:
+        cursor = conn.execute("INSERT OR IGNORE INTO FavoriteTrips (chat_id, start, finish, position) "
+                              "SELECT ?, ?, ?, COALESCE(MAX(position) + 1, 0) FROM FavoriteTrips WHERE chat_id = ?",
+                              (chat_id, start, finish, chat_id))
+    return cursor.rowcount == 1
 
 
 def get_favorite_trips(chat_id):
     """
     Функция извлекает избранные маршруты пользователя
     :param chat_id: ID пользователя
-    :return: Список избранных маршрутов
+    :return: Список избранных маршрутов в формате "станция->станция" в порядке добавления
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT favorite_trips FROM Users WHERE chat_id = ?", (chat_id,))
-    result = cursor.fetchone()
-    conn.close()
+    rows = get_db_connection().execute("SELECT start, finish FROM FavoriteTrips WHERE chat_id = ? ORDER BY position",
+                                       (chat_id,)).fetchall()
+    return [f"{start}->{finish}" for start, finish in rows]
+
+
+def remove_favorite_trip(chat_id, trip_to_remove) -> bool:
+    """
+    Функция удаляет избранный маршрут из списка избранных маршрутов пользователя
+    :param chat_id: ID пользователя
+    :param trip_to_remove: Маршрут, который нужно удалить, в формате "станция->станция"
+    :return: True, если маршрут был удалён
+    """
+    if not trip_to_remove or trip_to_remove.count("->") != 1:
+        return False
+
+    start, finish = trip_to_remove.split("->")
+    with transaction() as conn:
+        cursor = conn.execute("DELETE FROM FavoriteTrips WHERE chat_id = ? AND start = ? AND finish = ?",
+                              (chat_id, start, finish))
+    return cursor.rowcount == 1
+
+
+def get_legacy_bot_tokens() -> list:
+    """
+    Функция возвращает токены ботов, которые старые версии бота хранили в столбце favorite_trips служебного
+    пользователя с chat_id 1
+    :return: Список [токен основного бота, токен бота для обратной связи] или пустой список, если токенов нет
+    """
+    result = get_db_connection().execute("SELECT favorite_trips FROM Users "
+                                         "WHERE chat_id = 1 AND username = 'TOKENS'").fetchone()
     if result and result[0]:
         return json.loads(result[0])
     return []
 
 
-def remove_favorite_trip(chat_id, trip_to_remove):
+def delete_legacy_bot_tokens():
     """
-    Функция удаляет избранный маршрут из списка избранных маршрутов пользователя
-    :param chat_id: ID пользователя
-    :param trip_to_remove: Маршрут, который нужно удалить
-    """
-    favorite_trips = get_favorite_trips(chat_id)
-    if trip_to_remove in favorite_trips:
-        favorite_trips.remove(trip_to_remove)
-        trips_json = json.dumps(favorite_trips)
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE Users SET favorite_trips = ? WHERE chat_id = ?", (trips_json, chat_id))
-        conn.commit()
-        conn.close()
+    Функция удаляет служебного пользователя с chat_id 1 вместе с токенами ботов.
+    Вызывается только после того, как токены сохранены в config.json
+    """
+    with transaction() as conn:
+        conn.execute("DELETE FROM FavoriteTrips WHERE chat_id = 1")
+        conn.execute("DELETE FROM Users WHERE chat_id = 1 AND username = 'TOKENS'")
+
+    invalidate_user_cache(1)
@@ -0,0 +1,205 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import secrets
+import logging
+import queue
+import hmac
+import json
+import ssl
+
+import telebot
+from telebot import types
+
+from Config import get_settings
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Обновление от Telegram занимает единицы килобайт, всё, что заметно больше, отклоняется без чтения
+MAX_UPDATE_SIZE = 1024 * 1024
+
+_server = None
+_workers: list = []
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик запросов от Telegram: проверяет путь и секретный токен и ставит обновление в очередь,
+    не дожидаясь его обработки
+    """
+
+    def do_POST(self):
+        server: ThreadingHTTPServer = self.server
+
+        if self.path != server.webhook_path:
+            self.send_error(404)
+            return
+
+        received_token = self.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(received_token.encode("utf-8"), server.secret_token.encode("utf-8")):
+            self.send_error(403)
+            return
+
+        if self.headers.get("Content-Length") is None:
+            self.send_error(411)
+            return
+
+        try:
+            content_length = int(self.headers["Content-Length"])
+        except ValueError:
+            self.send_error(400)
+            return
+        if content_length < 0:
+            self.send_error(400)
+            return
+        if content_length > MAX_UPDATE_SIZE:
+            self.send_error(413)
+            return
+
+        try:
+            update_json = json.loads(self.rfile.read(content_length))
+            chat_id = _get_chat_id(update_json)
+        except (ValueError, TypeError, AttributeError, KeyError):
+            self.send_error(400)
+            return
+
+        # Обновления одного чата всегда попадают в одну очередь, поэтому обрабатываются по порядку
+        update_queue = server.update_queues[hash(chat_id) % len(server.update_queues)]
+        try:
+            update_queue.put_nowait(update_json)
+        except queue.Full:
+            # Telegram повторит доставку обновления позже
+            self.send_error(503)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.send_error(405)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def _get_chat_id(update_json: dict):
+    """
+    Функция определяет чат, к которому относится обновление, по JSON обновления
+    :param update_json: Обновление в виде словаря
+    :return: ID чата, а для обновлений без чата - ID обновления
+    """
+    for key in ("message", "edited_message", "callback_query"):
+        if key not in update_json:
+            continue
+
+        event = update_json[key]
+        if "chat" in event:
+            return event["chat"]["id"]
+        if "message" in event:
+            return event["message"]["chat"]["id"]
+        return event["from"]["id"]
+
+    return update_json["update_id"]
+
+
+def _worker_loop(bot: telebot.TeleBot, update_queue: queue.Queue):
+    """
+    Цикл обработчика очереди: передаёт обновления боту, пока в очередь не придёт None
+    :param bot: Бот с зарегистрированными обработчиками
+    :param update_queue: Очередь обновлений
+    """
+    while True:
+        update_json = update_queue.get()
+        if update_json is None:
+            break
+
+        try:
+            bot.process_new_updates([types.Update.de_json(update_json)])
+        except Exception:
+            logger.exception("Ошибка при обработке обновления %s", update_json.get("update_id"))
+
+
+def create_webhook_server(bot: telebot.TeleBot, host: str, port: int, path: str, secret_token: str,
+                          queue_size: int, workers: int) -> ThreadingHTTPServer:
+    """
+    Функция создаёт HTTP-сервер для приёма обновлений и запускает обработчики очередей.
+    Бот должен быть создан с threaded=False, иначе обработчики снова уйдут в пул потоков telebot
+    :param bot: Бот с зарегистрированными обработчиками
+    :param host: Адрес, на котором слушает сервер
+    :param port: Порт сервера. 0 - выбрать свободный порт
+    :param path: Путь, на который Telegram отправляет обновления
+    :param secret_token: Секретный токен, который Telegram передаёт в заголовке каждого запроса
+    :param queue_size: Общий размер очередей обновлений
+    :param workers: Количество потоков-обработчиков
+    :return: Объект сервера
+    """
+    global _server, _workers
+
+    server = ThreadingHTTPServer((host, port), WebhookRequestHandler)
+    server.daemon_threads = True
+    server.webhook_path = path
+    server.secret_token = secret_token
+    server.update_queues = [queue.Queue(maxsize=max(queue_size // workers, 1)) for _ in range(workers)]
+
+    _workers = [threading.Thread(target=_worker_loop, args=(bot, update_queue), name=f"WebhookWorker-{number}",
+                                 daemon=True)
+                for number, update_queue in enumerate(server.update_queues)]
+    for worker in _workers:
+        worker.start()
+
+    _server = server
+    return server
+
+
+def stop_webhook_server():
+    """
+    Функция останавливает сервер и дожидается обработки уже принятых обновлений
+    """
+    global _server, _workers
+
+    if _server is None:
+        return
+
+    _server.shutdown()
+    _server.server_close()
+    for update_queue in _server.update_queues:
+        update_queue.put(None)
+    for worker in _workers:
+        worker.join()
+
+    _server, _workers = None, []
+
+
+def run_webhook_bot(bot: telebot.TeleBot):
+    """
+    Функция регистрирует вебхук в Telegram и принимает обновления на встроенном HTTP-сервере вместо long polling.
+    Если секретный токен не задан в настройках, при каждом запуске генерируется новый
+    :param bot: Бот с зарегистрированными обработчиками
+    """
+    settings = get_settings()
+    secret_token = settings.webhook_secret or secrets.token_urlsafe(32)
+
+    server = create_webhook_server(bot, settings.webhook_host, settings.webhook_port, settings.webhook_path,
+                                   secret_token, settings.webhook_queue_size, settings.update_workers)
+
+    certificate = None
+    if settings.webhook_certificate and settings.webhook_private_key:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(settings.webhook_certificate, settings.webhook_private_key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        certificate = open(settings.webhook_certificate, "rb")
+
+    try:
+        bot.set_webhook(url=f"{settings.webhook_url.rstrip('/')}{settings.webhook_path}", certificate=certificate,
+                        secret_token=secret_token, drop_pending_updates=False)
+    finally:
+        if certificate is not None:
+            certificate.close()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_webhook_server()
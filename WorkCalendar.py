@@ -0,0 +1,98 @@
+from os import sep, stat
+from functools import lru_cache
+import threading
+import datetime
+import json
+
+from MetroClock import today
+
+CALENDAR_PATH = f"ScheduleDB{sep}calendar.json"
+
+WORKING_DAY_TYPE = "Рабочие"
+WEEKEND_DAY_TYPE = "Выходные"
+
+_calendar_lock = threading.Lock()
+# Порядковые номера дат (datetime.date.toordinal) выходных и рабочих дней, переопределяющих обычную неделю
+_calendar_index: tuple[frozenset, frozenset] = (frozenset(), frozenset())
+_calendar_mtime = None
+_calendar_version = 0
+
+
+def _get_calendar_mtime():
+    """
+    Функция возвращает время последнего изменения файла производственного календаря
+    :return: Время изменения в наносекундах или None, если файла нет
+    """
+    try:
+        return stat(CALENDAR_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_calendar(force: bool = False) -> tuple[frozenset, frozenset]:
+    """
+    Функция загружает переносы дней из файла "ScheduleDB/calendar.json" в индекс из множеств порядковых
+    номеров дат. Файл перечитывается только при изменении, поэтому календарь обновляется без изменения кода.
+    Формат файла: {"год": {"weekends": ["ГГГГ-ММ-ДД", ...], "working_days": ["ГГГГ-ММ-ДД", ...]}}
+    :param force: Перечитать файл, даже если он не изменялся
+    :return: Кортеж (выходные дни, рабочие дни)
+    """
+    global _calendar_index, _calendar_mtime, _calendar_version
+
+    mtime = _get_calendar_mtime()
+    if not force and mtime == _calendar_mtime:
+        return _calendar_index
+
+    with _calendar_lock:
+        mtime = _get_calendar_mtime()
+        if not force and mtime == _calendar_mtime:
+            return _calendar_index
+
+        weekends, working_days = set(), set()
+        if mtime is not None:
+            with open(CALENDAR_PATH, "r", encoding="utf-8") as file:
+                calendar: dict = json.load(file)
+
+            for year in calendar.values():
+                weekends.update(datetime.date.fromisoformat(day).toordinal() for day in year.get("weekends", []))
+                working_days.update(datetime.date.fromisoformat(day).toordinal()
+                                    for day in year.get("working_days", []))
+
+        _calendar_index, _calendar_mtime = (frozenset(weekends), frozenset(working_days)), mtime
+        _calendar_version += 1
+        return _calendar_index
+
+
+@lru_cache(maxsize=1024)
+def _get_day_type(ordinal: int, calendar_version: int) -> str:
+    """
+    Функция определяет тип дня по порядковому номеру даты. Результат запоминается для каждой версии календаря
+    :param ordinal: Порядковый номер даты
+    :param calendar_version: Версия загруженного календаря
+    :return: "Выходные" или "Рабочие"
+    """
+    weekends, working_days = _calendar_index
+
+    if ordinal in working_days:
+        return WORKING_DAY_TYPE
+    elif ordinal in weekends:
+        return WEEKEND_DAY_TYPE
+    elif datetime.date.fromordinal(ordinal).weekday() >= 5:
+        return WEEKEND_DAY_TYPE
+    else:
+        return WORKING_DAY_TYPE
+
+
+def get_day_type(date: datetime.date = None) -> str:
+    """
+    Функция проверяет переданную дату на принадлежность к выходному или рабочему дням с учётом переносов
+    из производственного календаря. Подходит и для будущих дат.
+    В случае, если дата не была передана - использует текущую дату в Екатеринбурге
+    :param date: дата в формате datetime.date
+    :return: Возвращает "Выходные", если переданная дата является выходным днём, и "Рабочие", если это рабочий день
+    """
+    if date is None:
+        date = today()
+
+    load_calendar()
+    return _get_day_type(date.toordinal(), _calendar_version)
@@ -0,0 +1,46 @@
+"""
+Замер скорости разбора сохранённых страниц станций: разбор через lxml против прежнего через BeautifulSoup.
+Запуск из корня репозитория: python tests/bench_parser.py [количество повторов]
+"""
+from os import path, chdir
+import statistics
+import time
+import sys
+
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from ScheduleParser import parse_station_page, names_saved_pages  # noqa: E402
+from reference_parser import parse_station_page_reference  # noqa: E402
+
+
+def bench(parser, stations: list, repeats: int) -> list[float]:
+    """
+    Функция замеряет время разбора всех страниц
+    :param parser: Функция разбора страницы станции
+    :param stations: Массив имён станций
+    :param repeats: Количество повторов
+    :return: Массив времён разбора всех страниц в секундах
+    """
+    timings = []
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        for name in stations:
+            parser(name)
+        timings.append(time.perf_counter() - started_at)
+    return timings
+
+
+def main():
+    chdir(ROOT_DIR)
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    stations = names_saved_pages[1:]
+
+    for title, parser in (("BeautifulSoup", parse_station_page_reference), ("lxml", parse_station_page)):
+        timings = bench(parser, stations, repeats)
+        print(f"{title:<14} {len(stations)} страниц: среднее {statistics.mean(timings) * 1000:.1f} мс, "
+              f"минимум {min(timings) * 1000:.1f} мс ({repeats} повторов)")
+
+
+if __name__ == '__main__':
+    main()
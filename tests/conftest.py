@@ -0,0 +1,5 @@
+from os import path
+import sys
+
+# Модули бота лежат в корне репозитория и импортируются тестами напрямую
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
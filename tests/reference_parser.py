@@ -0,0 +1,45 @@
+from bs4 import BeautifulSoup
+
+from ScheduleParser import get_src_file, direction_names
+
+
+def parse_station_page_reference(name: str) -> dict:
+    """
+    Прежний разбор страницы станции через BeautifulSoup. Оставлен как эталон, с которым сравнивается
+    разбор через lxml в ScheduleParser.parse_station_page
+    :param name: Имя файла страницы станции
+    :return: Словарь {тип дня: {направление: [времена]}}
+    """
+    station_schedule = {}
+
+    soup = BeautifulSoup(get_src_file(name), "lxml")
+
+    tables = soup.find_all('table', class_='uss_table_black10')
+
+    for table in tables:
+        label = table.find_previous_sibling('p').text.strip()
+
+        day_type, direction = label.split(" дни ")[0], label.split('"')[1]
+        direction = direction_names.get(direction.lower(), direction)
+
+        trains = []
+        rows = table.find_all('tr')
+        for row in rows[1:]:
+            cells = row.find_all('td')
+
+            hour = int(cells[0].text.strip())
+            if hour == 0:
+                hour = 24
+
+            minutes_str = cells[1].text.strip()
+            if minutes_str[-1] in ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]:
+                minutes = [int(item) for item in cells[1].text.strip().split(";")]
+            else:
+                minutes = [int(item) for item in cells[1].text.strip()[:-1].split(";")]
+
+            for minute in minutes:
+                trains.append(hour * 60 + minute)
+
+        station_schedule.setdefault(day_type, {})[direction] = trains
+
+    return station_schedule
@@ -0,0 +1,34 @@
+from os import path
+import json
+
+import pytest
+
+from ScheduleParser import parse_station_page, names_saved_pages
+from reference_parser import parse_station_page_reference
+
+ROOT_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+STATIONS = names_saved_pages[1:]
+
+
+@pytest.fixture(autouse=True)
+def root_dir(monkeypatch):
+    """
+    Пути к сохранённым страницам относительные, поэтому тесты выполняются из корня репозитория
+    """
+    monkeypatch.chdir(ROOT_DIR)
+
+
+@pytest.mark.parametrize("name", STATIONS)
+def test_lxml_parser_matches_reference(name):
+    schedule = parse_station_page(name)
+
+    assert schedule
+    assert schedule == parse_station_page_reference(name)
+
+
+@pytest.mark.parametrize("name", STATIONS)
+def test_lxml_parser_matches_saved_schedule(name):
+    with open(path.join("ScheduleDB", "schedule.json"), "r", encoding="utf-8") as file:
+        saved_schedule = json.load(file)
+
+    assert parse_station_page(name) == saved_schedule[name]
@@ -0,0 +1,79 @@
+import threading
+import datetime
+
+import pytest
+
+import UsersDataBase
+
+
+class SelectHook:
+    """
+    Обёртка соединения, которая после чтения строки пользователя даёт другому потоку записать очередь
+    """
+
+    def __init__(self, conn, after_select):
+        self.conn = conn
+        self.after_select = after_select
+
+    def execute(self, sql, *args):
+        cursor = self.conn.execute(sql, *args)
+        if sql.startswith("SELECT * FROM users WHERE chat_id"):
+            self.after_select()
+        return cursor
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """
+    Создаёт пустую базу пользователей во временной папке и сбрасывает кэш и очередь отложенной записи
+    """
+    monkeypatch.setattr(UsersDataBase, "DB_PATH", str(tmp_path / "users.db"))
+    monkeypatch.setattr(UsersDataBase, "_start_flush_thread", lambda: None)
+    monkeypatch.setattr(UsersDataBase, "_sessions", UsersDataBase.OrderedDict())
+    monkeypatch.setattr(UsersDataBase, "_pending_writes", {})
+    monkeypatch.setattr(UsersDataBase, "_pending_users", {})
+    UsersDataBase.close_db_connection()
+
+    UsersDataBase.create_table()
+    UsersDataBase.add_user(42, "tester", "Тест", "", datetime.date(2026, 1, 1))
+    yield
+    UsersDataBase.close_db_connection()
+
+
+def test_flush_between_select_and_merge_does_not_cache_stale_row(database, monkeypatch):
+    UsersDataBase.update_user_data(42, [5], ["Dinamo"])
+    UsersDataBase.invalidate_user_cache(42)
+
+    selected, flushed = threading.Event(), threading.Event()
+    reader = None
+    get_db_connection = UsersDataBase.get_db_connection
+
+    def after_select():
+        selected.set()
+        # Без блокировки запись очереди успевает завершиться здесь, до наложения отложенных изменений
+        flushed.wait(1)
+
+    def hooked_connection():
+        conn = get_db_connection()
+        if threading.current_thread() is reader:
+            return SelectHook(conn, after_select)
+        return conn
+
+    def flush():
+        UsersDataBase.flush_pending_writes()
+        UsersDataBase.close_db_connection()
+        flushed.set()
+
+    monkeypatch.setattr(UsersDataBase, "get_db_connection", hooked_connection)
+    result = {}
+    reader = threading.Thread(target=lambda: result.update(UsersDataBase.get_current_user(42)))
+    reader.start()
+
+    assert selected.wait(5)
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    reader.join(5)
+    flusher.join(5)
+
+    assert result["last_selected_start_station"] == "Dinamo"
+    assert UsersDataBase.get_current_user(42)["last_selected_start_station"] == "Dinamo"
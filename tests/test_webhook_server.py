@@ -0,0 +1,135 @@
+import urllib.request
+import urllib.error
+import http.client
+import threading
+import json
+
+import pytest
+import telebot
+
+from WebhookServer import create_webhook_server, stop_webhook_server, SECRET_TOKEN_HEADER
+
+WEBHOOK_PATH = "/telegram"
+SECRET_TOKEN = "test-secret"
+
+# Обновления в том виде, в котором их присылает Telegram
+MESSAGE_UPDATE = {
+    "update_id": 100,
+    "message": {
+        "message_id": 10,
+        "from": {"id": 42, "is_bot": False, "first_name": "Тест", "username": "tester"},
+        "chat": {"id": 42, "type": "private", "first_name": "Тест", "username": "tester"},
+        "date": 1717000000,
+        "text": "/start",
+        "entities": [{"offset": 0, "length": 6, "type": "bot_command"}]
+    }
+}
+CALLBACK_UPDATE = {
+    "update_id": 101,
+    "callback_query": {
+        "id": "4382bfdwdsb323b2d9",
+        "from": {"id": 42, "is_bot": False, "first_name": "Тест", "username": "tester"},
+        "message": {
+            "message_id": 11,
+            "from": {"id": 1, "is_bot": True, "first_name": "Бот", "username": "metro_bot"},
+            "chat": {"id": 42, "type": "private", "first_name": "Тест", "username": "tester"},
+            "date": 1717000001,
+            "text": "Выберите станцию"
+        },
+        "chat_instance": "-1234567890",
+        "data": "start_Dinamo"
+    }
+}
+
+
+@pytest.fixture
+def webhook():
+    """
+    Запускает сервер вебхука на свободном порту с ботом, который запоминает полученные обновления
+    """
+    bot = telebot.TeleBot("123456:TEST", threaded=False)
+    received = []
+    processed = threading.Semaphore(0)
+
+    @bot.message_handler(commands=["start"])
+    def on_start(message):
+        received.append(("message", message.chat.id, message.text))
+        processed.release()
+
+    @bot.callback_query_handler(func=lambda call: True)
+    def on_callback(call):
+        received.append(("callback", call.message.chat.id, call.data))
+        processed.release()
+
+    server = create_webhook_server(bot, "127.0.0.1", 0, WEBHOOK_PATH, SECRET_TOKEN, queue_size=10, workers=2)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    yield f"http://127.0.0.1:{server.server_address[1]}", received, processed
+
+    stop_webhook_server()
+    server_thread.join()
+
+
+def post(url: str, body: bytes, path: str = WEBHOOK_PATH, secret_token: str = SECRET_TOKEN) -> int:
+    """
+    Функция отправляет POST-запрос на сервер вебхука
+    :return: HTTP-код ответа
+    """
+    request = urllib.request.Request(f"{url}{path}", data=body, method="POST",
+                                     headers={SECRET_TOKEN_HEADER: secret_token, "Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+@pytest.mark.parametrize("update, expected", [
+    (MESSAGE_UPDATE, ("message", 42, "/start")),
+    (CALLBACK_UPDATE, ("callback", 42, "start_Dinamo")),
+])
+def test_update_is_processed(webhook, update, expected):
+    url, received, processed = webhook
+
+    assert post(url, json.dumps(update).encode("utf-8")) == 200
+    assert processed.acquire(timeout=5)
+    assert received == [expected]
+
+
+@pytest.mark.parametrize("body", [b"{}", b'{"update_id": 1, "message": {}}', b"[]", b"not json"])
+def test_malformed_update_is_rejected(webhook, body):
+    url, received, _ = webhook
+
+    assert post(url, body) == 400
+    assert received == []
+
+
+def test_wrong_secret_token_is_rejected(webhook):
+    url, received, _ = webhook
+
+    assert post(url, json.dumps(MESSAGE_UPDATE).encode("utf-8"), secret_token="wrong") == 403
+    assert received == []
+
+
+def test_wrong_path_is_rejected(webhook):
+    url, received, _ = webhook
+
+    assert post(url, json.dumps(MESSAGE_UPDATE).encode("utf-8"), path="/other") == 404
+    assert received == []
+
+
+@pytest.mark.parametrize("content_length, expected", [(None, 411), ("abc", 400), ("-1", 400), ("2000000", 413)])
+def test_bad_content_length_is_rejected(webhook, content_length, expected):
+    url, received, _ = webhook
+
+    connection = http.client.HTTPConnection(url.removeprefix("http://"), timeout=5)
+    connection.putrequest("POST", WEBHOOK_PATH)
+    connection.putheader(SECRET_TOKEN_HEADER, SECRET_TOKEN)
+    if content_length is not None:
+        connection.putheader("Content-Length", content_length)
+    connection.endheaders()
+
+    assert connection.getresponse().status == expected
+    assert received == []
+    connection.close()